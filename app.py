@@ -1,15 +1,37 @@
-from flask import Flask, request, jsonify, render_template_string, session, Response
+from flask import Flask, request, jsonify, render_template_string, session, Response, url_for
 import requests
 import os
 import secrets
-from datetime import datetime, timedelta, date
-from ics import Calendar, Event
+import threading
+import hashlib
+from datetime import datetime, timedelta, date, timezone
+from zoneinfo import ZoneInfo
 import re
-import pytz
+import sys
+import importlib
+from upstream import UpstreamClient, UpstreamUnavailable
+from precompressed import PrecompressedBody
+from compression import CompressionMiddleware
+from schedule_cache import ScheduleCache, ScheduleEntry, schedule_cache_from_env
+from session_store import ServerSideSessionInterface, store_from_env
+from assets import FONT_OUTPUT, SCRIPTS as CDN_SCRIPTS, AssetBundle
+from subscriptions import subscription_store_from_env
+from occupancy import NUM_SLOTS, SLOT_INDEX, SLOT_LABELS, Occupancy, bit, free_slots, iter_bits, position, week_parity
+import time
+import metrics
+from metrics import timed_iter, timed_stage
+import json
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
 # 優先從環境變數讀取 SECRET_KEY，如果沒有就隨機生成一個 (方便本地測試)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(16))
+# session 內容 (含整份 SubRESULT) 存在伺服器端，cookie 只帶 session id
+session_store = store_from_env()
+app.session_interface = ServerSideSessionInterface(session_store)
+# 課表 JSON/HTML、ICS 等動態回應依 Accept-Encoding 壓縮
+app.wsgi_app = CompressionMiddleware.wrap_from_env(app.wsgi_app)
 # --- 前端 HTML/CSS/JS 保持不變 ---
 html = '''
 <!DOCTYPE html>
@@ -18,12 +40,17 @@ html = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>SCU 課表查詢系統</title>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/html2canvas/1.4.1/html2canvas.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/jspdf/2.5.1/jspdf.umd.min.js"></script>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=Noto+Sans+TC:wght@300;400;500;700&display=swap" rel="stylesheet">
+    {% if font_url %}<link rel="preload" href="{{ font_url }}" as="font" type="font/woff2" crossorigin>{% endif %}
     <style>
+        {% if font_url %}
+        /* build_assets.py 產生的字型子集，只含介面用到的字元，其餘字元由後面的系統字型補上 */
+        @font-face {
+            font-family: 'Noto Sans TC';
+            src: url('{{ font_url }}') format('woff2');
+            font-weight: 300 700;
+            font-display: swap;
+        }
+        {% endif %}
         /* Dark Theme (Default) */
         :root {
             --bg-color: #000000;
@@ -62,7 +89,7 @@ html = '''
 
         /* Background with dots pattern */
         body {
-            font-family: 'Noto Sans TC', Arial, sans-serif;
+            font-family: 'Noto Sans TC', 'PingFang TC', 'Microsoft JhengHei', Arial, sans-serif;
             background-color: var(--bg-color);
             background-image: radial-gradient(circle, var(--dot-color) 1px, transparent 1px);
             background-size: 10px 10px;
@@ -623,6 +650,14 @@ html = '''
                     </svg>
                     添加到日曆 (.ics)
                 </button>
+                <button class="export-button" id="subscribeBtn">
+                    <svg class="export-icon" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+                        <path d="M4 11a9 9 0 0 1 9 9"/>
+                        <path d="M4 4a16 16 0 0 1 16 16"/>
+                        <circle cx="5" cy="19" r="1"/>
+                    </svg>
+                    訂閱行事曆
+                </button>
             </div>
         </div>
     </div>
@@ -750,6 +785,25 @@ html = '''
             document.getElementById("nextDay").disabled = (currentDayIndex === 6 && currentViewMode === "today");
         }
 
+        // 匯出用的函式庫只在第一次按下匯出時才載入，不影響首頁的載入
+        const EXPORT_LIBS = {{ export_libs|tojson }};
+        const scriptPromises = {};
+        function loadScript(src) {
+            if (!scriptPromises[src]) {
+                scriptPromises[src] = new Promise((resolve, reject) => {
+                    const script = document.createElement('script');
+                    script.src = src;
+                    script.onload = resolve;
+                    script.onerror = () => {
+                        delete scriptPromises[src];
+                        reject(new Error(`Failed to load ${src}`));
+                    };
+                    document.head.appendChild(script);
+                });
+            }
+            return scriptPromises[src];
+        }
+
         async function performExport(type) {
             const grid = document.querySelector('.course-grid');
             const btnId = `export${type}Btn`;
@@ -772,6 +826,7 @@ html = '''
             grid.querySelectorAll('.day-hidden').forEach(cell => cell.classList.remove('day-hidden'));
 
             try {
+                await Promise.all([loadScript(EXPORT_LIBS.html2canvas), type === 'Pdf' ? loadScript(EXPORT_LIBS.jspdf) : null]);
                 await new Promise(resolve => setTimeout(resolve, 100)); // Allow DOM to update
                 const canvas = await html2canvas(grid, {
                     scale: 2,
@@ -807,6 +862,23 @@ html = '''
             }
         }
 
+        // 伺服器直接產生向量 PDF (幾 KB)；session 過期等失敗情況才退回瀏覽器端轉圖
+        async function exportServerPdf() {
+            try {
+                const response = await fetch('/api/export/pdf');
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                const url = URL.createObjectURL(await response.blob());
+                const link = document.createElement('a');
+                link.download = 'course_schedule.pdf';
+                link.href = url;
+                link.click();
+                setTimeout(() => URL.revokeObjectURL(url), 1000);
+            } catch (error) {
+                console.warn('Server PDF export failed, falling back:', error);
+                await performExport("Pdf");
+            }
+        }
+
         // Cache for course data
         let courseDataCache = null;
 
@@ -827,12 +899,29 @@ html = '''
             });
 
             document.getElementById("exportPngBtn").addEventListener("click", () => performExport("Png"));
-            document.getElementById("exportPdfBtn").addEventListener("click", () => performExport("Pdf"));
+            document.getElementById("exportPdfBtn").addEventListener("click", exportServerPdf);
             
             document.getElementById("exportIcsBtn").addEventListener("click", function() {
                 window.location.href = '/api/export/ics';
             });
 
+            // 產生訂閱網址：webcal:// 交給系統行事曆，https 網址可貼到 Google 日曆「從網址新增」
+            document.getElementById("subscribeBtn").addEventListener("click", async function() {
+                const messageDiv = document.getElementById("message");
+                try {
+                    const response = await fetch('/api/subscription', { method: 'POST' });
+                    const result = await response.json();
+                    if (result.status !== "success") {
+                        messageDiv.innerHTML = `<div class="error">訂閱失敗: ${result.message}</div>`;
+                        return;
+                    }
+                    messageDiv.innerHTML = `<div class="success">訂閱網址 (請勿分享)：<a href="${result.webcal}">${result.url}</a></div>`;
+                    window.location.href = result.webcal;
+                } catch (error) {
+                    messageDiv.innerHTML = `<div class="error">訂閱錯誤: ${error.message}</div>`;
+                }
+            });
+
             document.getElementById("prevDay").addEventListener("click", () => {
                 if (currentDayIndex > 0) {
                     currentDayIndex--;
@@ -867,28 +956,76 @@ html = '''
             document.getElementById("courseContent").classList.remove("visible");
 
             try {
-                const response = await fetch("/api/login", {
+                // 一次往返完成登入與課表查詢
+                const response = await fetch("/api/schedule", {
                     method: "POST",
                     headers: { "Content-Type": "application/json" },
-                    body: JSON.stringify({ userid: userid, password: password }),
+                    body: JSON.stringify({ userid: userid, password: password, format: "json" }),
                 });
                 const result = await response.json();
 
                 if (result.status === "success") {
-                    messageDiv.innerHTML = '<div class="success">登入成功！正在獲取課表...</div>';
-                    await getCourseTable(result.data);
+                    showCourseTable(result);
+                } else if (result.stage === "course") {
+                    messageDiv.innerHTML = `<div class="error">課表獲取失敗: ${result.message}</div>`;
                 } else {
                     messageDiv.innerHTML = `<div class="error">登入失敗: ${result.message}</div>`;
-                    loginBtn.disabled = false;
-                    loginBtn.textContent = "登入並查詢課表";
                 }
             } catch (error) {
                 messageDiv.innerHTML = `<div class="error">發生錯誤: ${error.message}</div>`;
+            } finally {
                 loginBtn.disabled = false;
-                loginBtn.textContent = "登入並查詢課表";
+                loginBtn.textContent = document.getElementById("courseContent").classList.contains("visible") ? "重新查詢" : "登入並查詢課表";
             }
         });
 
+        function showCourseTable(result) {
+            const messageDiv = document.getElementById("message");
+            // 緩存課表數據
+            courseDataCache = result.courseData; // 需要後端返回原始數據
+
+            document.getElementById("loginForm").style.display = "none";
+            document.getElementById("mainTitle").textContent = "您的課表";
+            messageDiv.innerHTML = '<div class="success">課表獲取成功！</div>';
+            const courseContent = document.getElementById("courseContent");
+
+            document.getElementById("courseData").innerHTML = result.schedule ? renderCourseGrid(result.schedule) : result.content;
+            courseContent.classList.add("visible");
+            document.getElementById("exportContainer").style.display = "flex";
+            setupMobileView();
+        }
+
+        // 由 format=json 的結構化課表在瀏覽器端組出與伺服器 HTML 相同的格線
+        function renderCourseGrid(schedule) {
+            const { year, semester, days, slots, cells } = schedule;
+            const courseAt = new Map(cells.map(cell => [cell[0] * 7 + cell[1], cell]));
+            const coveredUntil = new Array(7).fill(-1);
+            const parts = [
+                '<div class="course-grid">',
+                `<div id="courseTableTitle">${year} 學年度 第 ${semester} 學期</div>`,
+                '<div class="grid-cell grid-time-header"></div>'
+            ];
+            days.forEach((dayName, i) => parts.push(`<div class="grid-cell grid-header" data-day-index="${i}">${dayName}</div>`));
+            slots.forEach(([label, time, weekEmpty], slotIdx) => {
+                parts.push(`<div class="grid-cell grid-slot-time" data-slot-index="${slotIdx}" data-is-week-empty="${weekEmpty ? "true" : "false"}"><span class="content-normal">${label}<br>${time}</span><span class="content-collapsed">${label} ${time.replaceAll("<br>", " - ")}</span></div>`);
+                for (let dayIdx = 0; dayIdx < 7; dayIdx++) {
+                    if (slotIdx <= coveredUntil[dayIdx]) continue; // 被上方跨節課程佔用
+                    const cell = courseAt.get(slotIdx * 7 + dayIdx);
+                    if (cell) {
+                        const [, , span, courseId, text] = cell;
+                        coveredUntil[dayIdx] = slotIdx + span - 1;
+                        const rowspan = span > 1 ? ` style="grid-row-end: span ${span};"` : "";
+                        parts.push(`<div class="grid-cell grid-course has-course" data-is-empty="false" data-slot-index="${slotIdx}" data-day-index="${dayIdx}"${rowspan}><a href="https://mobile.sys.scu.edu.tw/performance/performance/${year}/${semester}/${courseId}" target="_blank">${text}</a></div>`);
+                    } else {
+                        parts.push(`<div class="grid-cell grid-course empty" data-is-empty="true" data-slot-index="${slotIdx}" data-day-index="${dayIdx}">&nbsp;</div>`);
+                    }
+                }
+            });
+            parts.push('</div>');
+            return parts.join("");
+        }
+
+        // 兩段式流程 (/api/login → /api/course) 保留給既有呼叫端
         async function getCourseTable(loginData) {
             const messageDiv = document.getElementById("message");
             try {
@@ -899,18 +1036,7 @@ html = '''
                 });
                 const result = await response.json();
                 if (result.status === "success") {
-                    // 緩存課表數據
-                    courseDataCache = result.courseData; // 需要後端返回原始數據
-                    
-                    document.getElementById("loginForm").style.display = "none";
-                    document.getElementById("mainTitle").textContent = "您的課表";
-                    messageDiv.innerHTML = '<div class="success">課表獲取成功！</div>';
-                    const courseContent = document.getElementById("courseContent");
-
-                    document.getElementById("courseData").innerHTML = result.content;
-                    courseContent.classList.add("visible");
-                    document.getElementById("exportContainer").style.display = "flex";
-                    setupMobileView();
+                    showCourseTable(result);
                 } else {
                     messageDiv.innerHTML = `<div class="error">課表獲取失敗: ${result.message}</div>`;
                 }
@@ -929,27 +1055,123 @@ html = '''
 '''
 
 # 原始系統的基礎 URL
-BASE_URL = "https://psv.scu.edu.tw/portal"
+BASE_URL = os.environ.get('SCU_BASE_URL', "https://psv.scu.edu.tw/portal")
+# 每個 worker 共用一個 keep-alive 連線池
+upstream = UpstreamClient.from_env(BASE_URL)
+# 以 (userId, 學年, 學期) 為鍵的課表快取；sqlite 後端由所有 worker 共用 (process_course_data 定義在後面，所以包一層)
+schedule_cache = schedule_cache_from_env(lambda sub_result: process_course_data(sub_result))
+# webcal 訂閱的 token 與預先產生的行事曆
+subscription_store = subscription_store_from_env()
+
+# 自架的靜態資源；沒有執行 build_assets.py 時，匯出函式庫退回 CDN、字型改用系統字型
+asset_bundle = AssetBundle.from_env()
+EXPORT_LIBS = {'html2canvas': asset_bundle.url('html2canvas.min.js', CDN_SCRIPTS['html2canvas.min.js']),
+               'jspdf': asset_bundle.url('jspdf.umd.min.js', CDN_SCRIPTS['jspdf.umd.min.js'])}
+
+# 首頁的模板變數只有資源網址，啟動時渲染一次並預先壓縮，之後每次請求只挑選現成的位元組
+with app.app_context():
+    index_page = PrecompressedBody(render_template_string(html, font_url=asset_bundle.url(FONT_OUTPUT), export_libs=EXPORT_LIBS),
+                                   'text/html', max_age=int(os.environ.get('INDEX_MAX_AGE', 86400)), cache_dir=asset_bundle.cache_dir)
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    body = asset_bundle.get(filename)
+    if body is None:
+        return "Not Found", 404
+    return body.response(request)
+
+def metrics_route():
+    # 以路由規則而非實際路徑當 label，避免掃描器打出的 404 路徑讓 label 無限增加
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    request.environ['scu.metrics_start'] = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    start = request.environ.get('scu.metrics_start')
+    if start is None:
+        return response
+    route = request.environ['scu.metrics_route'] = metrics_route()
+    metrics.HTTP_REQUESTS.inc(route, request.method, response.status_code)
+    metrics.HTTP_LATENCY.observe(route, value=time.perf_counter() - start)
+    # 串流回應要先判斷：calculate_content_length() 會把 generator 整個讀進記憶體，串流就失效了
+    if response.is_streamed:
+        response.response = metrics.count_bytes(route, response.response)
+    else:
+        size = response.calculate_content_length()
+        if size is not None:
+            metrics.HTTP_RESPONSE_SIZE.observe(route, value=size)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if request.environ.pop('scu.metrics_start', None) is not None:
+        metrics.HTTP_IN_FLIGHT.dec()
+
+# 連線池與斷路器的指標取自實際呼叫上游的 client；ASGI 模式由 asgi.py 換成 AsyncUpstreamClient
+metrics_upstream = upstream
+
+def collect_runtime_metrics():
+    pool, cache = metrics_upstream.pool_stats(), schedule_cache.stats()
+    return [
+        ("scu_upstream_pool_connections_total", "counter", "Upstream requests by whether a pooled connection was reused.",
+         [({"result": "hit"}, pool["hits"]), ({"result": "miss"}, pool["misses"])]),
+        ("scu_upstream_circuit_state", "gauge", "1 for the circuit breaker's current state.",
+         [({"state": state}, int(pool["breaker"]["state"] == state)) for state in ("closed", "open", "half_open")]),
+        ("scu_upstream_inflight_waiters", "gauge", "Callers currently waiting on an identical in-flight upstream request.",
+         [({}, sum(pool.get("inflight_waiters", {}).values()))]),
+        ("scu_schedule_cache_lookups_total", "counter", "Schedule cache lookups by result.",
+         [({"result": "fresh"}, cache["hits"]), ({"result": "stale"}, cache["stale_hits"]), ({"result": "miss"}, cache["misses"])]),
+        ("scu_schedule_cache_artifact_lookups_total", "counter", "Pre-rendered grid HTML/ICS lookups by result.",
+         [({"result": "hit"}, cache["artifact_hits"]), ({"result": "miss"}, cache["artifact_misses"])]),
+        ("scu_schedule_cache_entries", "gauge", "Schedules currently cached.", [({}, cache["entries"])]),
+        ("scu_schedule_cache_bytes", "gauge", "Estimated size of the schedule cache.", [({}, cache["bytes"])]),
+    ]
+
+metrics.REGISTRY.add_collector(collect_runtime_metrics)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
-    return render_template_string(html)
+    return index_page.response(request)
+
+def parse_login_response(response_data):
+    """解析上游 Login 回傳，回傳 (登入資料, 錯誤訊息)"""
+    if response_data.get('status') != 'success':
+        return None, response_data.get('message', '登入失敗')
+    user_info = response_data.get('message', {})
+    return { "sessionID": user_info.get('sessionID'), "userId": user_info.get('userId'), "sessionCode": user_info.get('sessionCode'), "name": user_info.get('name'), "unit": user_info.get('unit'), }, None
+
+def login_upstream(userid, password):
+    """向上游登入，回傳 (登入資料, 錯誤訊息)"""
+    login_data, error_message = parse_login_response(upstream.call("Login", userid=userid, password=password))
+    if login_data is not None:
+        # 登入後換發 session id，事先植入的 cookie 不會因此取得登入身分
+        session.regenerate()
+        # 記下已通過上游驗證的學號，課表快取只對同一學號開放
+        session['uid'] = login_data['userId']
+    return login_data, error_message
+
+def upstream_unavailable(e, **extra):
+    # 斷路器跳脫或上游名額已滿：不等待校務系統，立即回覆並告知何時再試
+    return jsonify({"status": "error", "message": str(e), **extra}), 503, {"Retry-After": str(e.retry_after)}
 
 @app.route('/api/login', methods=['POST'])
 def api_login():
     data = request.get_json()
     userid, password = data.get('userid'), data.get('password')
-    url = f"{BASE_URL}/jsonApi.php"
-    payload = { "libName": "Login", "userid": userid, "password": password }
-    headers = { "Content-Type": "application/x-www-form-urlencoded", "User-Agent": "Mozilla/5.0", "Referer": BASE_URL }
     try:
-        response = requests.post(url, data=payload, headers=headers)
-        response.raise_for_status()
-        response_data = response.json()
-        if response_data.get('status') == 'success':
-            user_info = response_data.get('message', {})
-            return jsonify({ "status": "success", "message": "登入成功", "data": { "sessionID": user_info.get('sessionID'), "userId": user_info.get('userId'), "sessionCode": user_info.get('sessionCode'), "name": user_info.get('name'), "unit": user_info.get('unit'), }})
-        else: return jsonify({"status": "error", "message": response_data.get('message', '登入失敗')})
+        login_data, error_message = login_upstream(userid, password)
+        if login_data is not None:
+            return jsonify({ "status": "success", "message": "登入成功", "data": login_data })
+        else: return jsonify({"status": "error", "message": error_message})
+    except UpstreamUnavailable as e: return upstream_unavailable(e)
     except requests.RequestException as e: return jsonify({"status": "error", "message": f"連線錯誤: {str(e)}"}), 500
     except Exception as e: return jsonify({"status": "error", "message": f"處理登入回傳失敗: {str(e)}"}), 500
 
@@ -958,27 +1180,182 @@ def cours_table_td_data(s):
     s = s.replace(' ', ' ').replace('��', '').replace('<br/>', '<br>').replace('<br><br>', '<br>')
     return s.strip()
 
+DAY_KEYS = [f'day{day_idx + 1}' for day_idx in range(7)]
+COURID_KEYS = [f'day{day_idx + 1}Courid' for day_idx in range(7)]
+
+class CourseGrid:
+    """以 slot * 7 + day 為索引的平行陣列課表；span 為 0 的格子被上方的跨節課程佔用"""
+    __slots__ = ('num_slots', 'course_ids', 'course_texts', 'raw_texts', 'spans', 'is_row_week_empty')
+
+    def __init__(self, num_slots):
+        size = num_slots * 7
+        self.num_slots = num_slots
+        self.course_ids = [''] * size
+        self.course_texts = [''] * size
+        self.raw_texts = [''] * size
+        self.spans = bytearray(size)
+        self.is_row_week_empty = [True] * num_slots
+
+    def has_course(self, i):
+        return bool(self.course_ids[i]) and bool(self.course_texts[i].strip())
+
+@timed_stage('process_course_data')
 def process_course_data(raw_data):
     num_slots = len(raw_data)
-    temp_grid = [[{'course_id': '', 'course_text': '', 'span': 0, 'raw_text': ''} for _ in range(7)] for _ in range(num_slots)]
-    is_row_week_empty = [True] * num_slots
+    grid = CourseGrid(num_slots)
+    course_ids, course_texts, raw_texts, spans = grid.course_ids, grid.course_texts, grid.raw_texts, grid.spans
+    is_row_week_empty = grid.is_row_week_empty
+    # 同一份課表裡重複的課程文字只清理一次，並 intern 讓快取中的多份課表共用字串
+    cleaned = {}
+    run_start = [-1] * 7
     for slot_idx, slot_data in enumerate(raw_data):
+        base = slot_idx * 7
         for day_idx in range(7):
-            api_day_key, api_courid_key = f'day{day_idx + 1}', f'day{day_idx + 1}Courid'
-            raw_text = slot_data.get(api_day_key, '')
-            course_text = cours_table_td_data(raw_text)
-            course_id = slot_data.get(api_courid_key, '')
+            raw_text = slot_data.get(DAY_KEYS[day_idx], '') or ''
+            course_id = slot_data.get(COURID_KEYS[day_idx], '') or ''
+            start = run_start[day_idx]
+            # 與上一節同課號、同原始文字時併入上方的格子 (單趟合併，不重新配置)
+            if course_id and start >= 0 and course_ids[start] == course_id and raw_texts[start] == raw_text:
+                spans[start] += 1
+                is_row_week_empty[slot_idx - 1] = False
+                if course_texts[start].strip(): is_row_week_empty[slot_idx] = False
+                continue
+            course_text = cleaned.get(raw_text)
+            if course_text is None:
+                course_text = cleaned[raw_text] = sys.intern(cours_table_td_data(raw_text))
+            i = base + day_idx
+            course_ids[i], course_texts[i], raw_texts[i], spans[i] = sys.intern(course_id), course_text, sys.intern(raw_text), 1
             if course_id and course_text.strip(): is_row_week_empty[slot_idx] = False
-            temp_grid[slot_idx][day_idx] = {'course_id': course_id, 'course_text': course_text, 'span': 1, 'raw_text': raw_text}
-    for day_idx in range(7):
-        for slot_idx in range(num_slots - 2, -1, -1):
-            current_cell_data, next_cell_data = temp_grid[slot_idx][day_idx], temp_grid[slot_idx + 1][day_idx]
-            if (current_cell_data['course_id'] and current_cell_data['course_id'] == next_cell_data['course_id'] and
-                current_cell_data['raw_text'] == next_cell_data['raw_text'] and next_cell_data['span'] > 0):
-                current_cell_data['span'] += next_cell_data['span']
-                next_cell_data['span'] = 0
-                if is_row_week_empty[slot_idx]: is_row_week_empty[slot_idx] = False
-    return temp_grid, is_row_week_empty
+            run_start[day_idx] = i if course_id else -1
+    return grid
+
+def parse_course_response(course_data, user_id, session_uid):
+    """解析上游 CourseTable 回傳並寫入課表快取，回傳 (entry, 錯誤訊息)"""
+    if course_data.get('status') != 'success':
+        return None, course_data.get('message', '獲取課表失敗')
+    message_data = course_data.get('message', {})
+    sub_result = message_data.get('SubRESULT', [])
+    time_info = message_data.get('time', '').strip().replace(' ', '')
+    year, semester = int(time_info[0:3]), int(time_info[6])
+    grid = process_course_data(sub_result)
+    # user_id 來自請求內容，只有 session 內登入的學號才寫入快取與訂閱行事曆，不能以他人的學號覆寫對方的資料
+    if user_id != session_uid:
+        return ScheduleEntry(user_id, year, semester, sub_result, grid, 0, 0), None
+    entry = schedule_cache.put(user_id, year, semester, sub_result, grid)
+    refresh_subscription_feed(user_id, sub_result)
+    return entry, None
+
+def refresh_subscription_feed(user_id, sub_result):
+    # 只在向上游查到課表時執行；有訂閱的使用者才重新產生行事曆，內容沒變時 store 不會改寫
+    if subscription_store.is_subscribed(user_id):
+        subscription_store.put_feed(user_id, build_subscription_feed(sub_result))
+
+def fetch_schedule(login_params, session_uid):
+    """向上游取得 CourseTable 並寫入課表快取，回傳 (entry, 錯誤訊息)"""
+    return parse_course_response(upstream.call("CourseTable", **login_params), login_params['api_loginID'], session_uid)
+
+def revalidate_schedule(key, login_params, session_uid):
+    # stale-while-revalidate：背景更新失敗就繼續使用舊資料
+    try:
+        fetch_schedule(login_params, session_uid)
+    except Exception:
+        pass
+    finally:
+        schedule_cache.end_refresh(key)
+
+COURSE_TIME_LABELS = ['08:10 <br> 09:00', '09:10 <br> 10:00', '10:10 <br> 11:00', '11:10 <br> 12:00', '12:10 <br> 13:00', '13:10 <br> 14:00', '14:10 <br> 15:00', '15:10 <br> 16:00', '16:10 <br> 17:00', '17:10 <br> 18:20', '18:25 <br> 19:15', '19:20 <br> 20:10', '20:20 <br> 21:10', '21:15 <br> 22:05']
+WEEK_DAY_LABELS = ['週一 <br> Mon', '週二 <br> TUE', '週三 <br> WED', '週四 <br> THU', '週五 <br> FRI', '週六 <br> SAT', '週日 <br> SUN']
+
+@timed_stage('render_grid_html')
+def render_grid_html(entry):
+    sub_result, year, semester, grid = entry.sub_result, entry.year, entry.semester, entry.grid
+    is_row_week_empty = grid.is_row_week_empty
+    course_table_title = f"{year} 學年度 第 {semester} 學期"
+    course_time, week_days = COURSE_TIME_LABELS, WEEK_DAY_LABELS
+    num_slots = len(sub_result)
+    grid_html = '<div class="course-grid">'
+    grid_html += f'<div id="courseTableTitle">{course_table_title}</div>'
+    grid_html += '<div class="grid-cell grid-time-header"></div>'
+    for i, day_name in enumerate(week_days):
+        grid_html += f'<div class="grid-cell grid-header" data-day-index="{i}">{day_name}</div>'
+    for slot_idx in range(num_slots):
+        is_week_empty_attr = 'true' if is_row_week_empty[slot_idx] else 'false'
+        slot_label = sub_result[slot_idx].get("slot", "")
+        time_period_text = course_time[slot_idx] if 0 <= slot_idx < len(course_time) else ""
+        content_normal = f'<span class="content-normal">{slot_label}<br>{time_period_text}</span>'
+        content_collapsed = f'<span class="content-collapsed">{slot_label} {time_period_text.replace("<br>", " - ")}</span>'
+        grid_html += f'<div class="grid-cell grid-slot-time" data-slot-index="{slot_idx}" data-is-week-empty="{is_week_empty_attr}">{content_normal}{content_collapsed}</div>'
+        for day_idx in range(7):
+            i = slot_idx * 7 + day_idx
+            span = grid.spans[i]
+            if span > 0:
+                course_text, course_id = grid.course_texts[i], grid.course_ids[i]
+                rowspan_attr = f'style="grid-row-end: span {span};"' if span > 1 else ''
+                is_empty_attr = 'true' if not (course_id and course_text.strip()) else 'false'
+                if is_empty_attr == 'false':
+                    link_url = f"https://mobile.sys.scu.edu.tw/performance/performance/{year}/{semester}/{course_id}"
+                    grid_html += f'<div class="grid-cell grid-course has-course" data-is-empty="false" data-slot-index="{slot_idx}" data-day-index="{day_idx}" {rowspan_attr}><a href="{link_url}" target="_blank">{course_text}</a></div>'
+                else:
+                    grid_html += f'<div class="grid-cell grid-course empty" data-is-empty="true" data-slot-index="{slot_idx}" data-day-index="{day_idx}" {rowspan_attr}> </div>'
+    grid_html += '</div>'
+    return grid_html
+
+@timed_stage('schedule_json')
+def schedule_json(entry):
+    """前端自行繪製格線用的精簡課表：cells 只列出有課的格子 [slot, day, span, 課號, 課程文字]"""
+    sub_result, grid = entry.sub_result, entry.grid
+    slots = [[row.get("slot", ""), COURSE_TIME_LABELS[i] if i < len(COURSE_TIME_LABELS) else "", int(grid.is_row_week_empty[i])]
+             for i, row in enumerate(sub_result)]
+    cells = [[i // 7, i % 7, span, grid.course_ids[i], grid.course_texts[i]]
+             for i, span in enumerate(grid.spans) if span > 0 and grid.has_course(i)]
+    return {"year": entry.year, "semester": entry.semester, "days": WEEK_DAY_LABELS, "slots": slots, "cells": cells}
+
+GRID_HTML_VERSION = 1
+
+def cached_grid_html(entry):
+    """格線 HTML 以課表內容的雜湊存成快取 artifact，所有 worker 對同一份課表只渲染一次"""
+    if entry.digest is None:
+        return render_grid_html(entry)
+    name = f"grid:{GRID_HTML_VERSION}:{entry.digest}:{entry.year}:{entry.semester}"
+    body = schedule_cache.get_artifact(name)
+    if body is not None:
+        return body.decode('utf-8')
+    grid_html = render_grid_html(entry)
+    schedule_cache.put_artifact(name, grid_html.encode('utf-8'))
+    return grid_html
+
+def schedule_payload(entry, fmt):
+    """format=json 回傳結構化課表，否則維持原本的格線 HTML"""
+    if fmt == 'json':
+        return {"schedule": schedule_json(entry)}
+    return {"content": cached_grid_html(entry)}
+
+def session_course_data(entry, previous=None):
+    # 匯出 ICS/SVG/PDF 時只依賴 session 內的這份資料；updated_at 只在課表內容改變時更新，作為 ICS 的 Last-Modified
+    updated_at = previous.get('updated_at') if previous and previous.get('sub_result') == entry.sub_result else None
+    return { 'sub_result': entry.sub_result, 'year': entry.year, 'semester': entry.semester, 'updated_at': updated_at or int(time.time()) }
+
+def course_login_params(login_data):
+    return { "api_loginstr": login_data['sessionID'], "api_loginID": login_data['userId'], "api_encodeID": login_data['sessionCode'], "api_stuname": login_data['name'], "api_clsname": login_data['unit'] }
+
+def lookup_cached_schedule(login_data, options, session_uid, bypass_cache=False):
+    """快取只提供給在本瀏覽器登入過同一學號的使用者，回傳 (entry, 狀態)"""
+    user_id = login_data['userId']
+    if bypass_cache or bool(options.get('refresh')) or session_uid != user_id:
+        return None, None
+    return schedule_cache.lookup(user_id, options.get('year'), options.get('semester'))
+
+def load_schedule(login_data, options):
+    """依登入資料取得課表，可用時優先走快取，回傳 (entry, 錯誤訊息)"""
+    login_params = course_login_params(login_data)
+    # refresh 為強制重新向上游查詢
+    session_uid = session.get('uid')
+    entry, state = lookup_cached_schedule(login_data, options, session_uid, request.args.get('refresh') == '1')
+    if entry is None:
+        return fetch_schedule(login_params, session_uid)
+    if state == ScheduleCache.STALE and schedule_cache.begin_refresh(entry.key):
+        threading.Thread(target=revalidate_schedule, args=(entry.key, login_params, session_uid), daemon=True).start()
+    return entry, None
 
 @app.route('/api/course', methods=['POST'])
 def api_course():
@@ -986,195 +1363,555 @@ def api_course():
     session_id, user_id, session_code, user_name, user_unit = data.get('sessionID'), data.get('userId'), data.get('sessionCode'), data.get('name'), data.get('unit')
     if not all([session_id, user_id, session_code, user_name, user_unit]):
         return jsonify({"status": "error", "message": "缺少必要的登入資訊來獲取課表"}), 400
-    course_api_url = f"{BASE_URL}/jsonApi.php"
-    course_payload = { "libName": "CourseTable", "api_loginstr": session_id, "api_loginID": user_id, "api_encodeID": session_code, "api_stuname": user_name, "api_clsname": user_unit }
-    headers = { "Content-Type": "application/x-www-form-urlencoded", "User-Agent": "Mozilla/5.0", "Referer": BASE_URL }
     try:
-        response = requests.post(course_api_url, data=course_payload, headers=headers)
-        response.raise_for_status()
-        course_data = response.json()
-        if course_data.get('status') == 'success':
-            message_data = course_data.get('message', {})
-            sub_result = message_data.get('SubRESULT', [])
-            time_info = message_data.get('time', '').strip().replace(' ', '')
-            year, semester = int(time_info[0:3]), int(time_info[6])
-            session['course_data'] = { 'sub_result': sub_result }
-            temp_grid, is_row_week_empty = process_course_data(sub_result)
-            course_table_title = f"{year} 學年度 第 {semester} 學期"
-            course_time = ['08:10 <br> 09:00', '09:10 <br> 10:00', '10:10 <br> 11:00', '11:10 <br> 12:00', '12:10 <br> 13:00', '13:10 <br> 14:00', '14:10 <br> 15:00', '15:10 <br> 16:00', '16:10 <br> 17:00', '17:10 <br> 18:20', '18:25 <br> 19:15', '19:20 <br> 20:10', '20:20 <br> 21:10', '21:15 <br> 22:05']
-            week_days = ['週一 <br> Mon', '週二 <br> TUE', '週三 <br> WED', '週四 <br> THU', '週五 <br> FRI', '週六 <br> SAT', '週日 <br> SUN']
-            num_slots = len(sub_result)
-            grid_html = '<div class="course-grid">'
-            grid_html += f'<div id="courseTableTitle">{course_table_title}</div>'
-            grid_html += '<div class="grid-cell grid-time-header"></div>'
-            for i, day_name in enumerate(week_days):
-                grid_html += f'<div class="grid-cell grid-header" data-day-index="{i}">{day_name}</div>'
-            for slot_idx in range(num_slots):
-                is_week_empty_attr = 'true' if is_row_week_empty[slot_idx] else 'false'
-                slot_label = sub_result[slot_idx].get("slot", "")
-                time_period_text = course_time[slot_idx] if 0 <= slot_idx < len(course_time) else ""
-                content_normal = f'<span class="content-normal">{slot_label}<br>{time_period_text}</span>'
-                content_collapsed = f'<span class="content-collapsed">{slot_label} {time_period_text.replace("<br>", " - ")}</span>'
-                grid_html += f'<div class="grid-cell grid-slot-time" data-slot-index="{slot_idx}" data-is-week-empty="{is_week_empty_attr}">{content_normal}{content_collapsed}</div>'
-                for day_idx in range(7):
-                    cell_to_render = temp_grid[slot_idx][day_idx]
-                    if cell_to_render['span'] > 0:
-                        course_text, course_id = cell_to_render['course_text'], cell_to_render['course_id']
-                        rowspan_attr = f'style="grid-row-end: span {cell_to_render["span"]};"' if cell_to_render['span'] > 1 else ''
-                        is_empty_attr = 'true' if not (course_id and course_text.strip()) else 'false'
-                        if is_empty_attr == 'false':
-                            link_url = f"https://mobile.sys.scu.edu.tw/performance/performance/{year}/{semester}/{course_id}"
-                            grid_html += f'<div class="grid-cell grid-course has-course" data-is-empty="false" data-slot-index="{slot_idx}" data-day-index="{day_idx}" {rowspan_attr}><a href="{link_url}" target="_blank">{course_text}</a></div>'
-                        else:
-                            grid_html += f'<div class="grid-cell grid-course empty" data-is-empty="true" data-slot-index="{slot_idx}" data-day-index="{day_idx}" {rowspan_attr}> </div>'
-            grid_html += '</div>'
-            return jsonify({"status": "success", "content": grid_html})
-        else:
-            return jsonify({"status": "error", "message": course_data.get('message', '獲取課表失敗')})
+        entry, error_message = load_schedule(data, data)
+        if entry is None:
+            return jsonify({"status": "error", "message": error_message})
+        session['course_data'] = session_course_data(entry, session.get('course_data'))
+        return jsonify({"status": "success", **schedule_payload(entry, data.get('format') or request.args.get('format'))})
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
     except Exception as e:
         return jsonify({"status": "error", "message": f"處理課表數據失敗: {str(e)}"}), 500
 
+# 登入與查詢課表合併成一次往返，stage 標示失敗發生在哪一步
+@app.route('/api/schedule', methods=['POST'])
+def api_schedule():
+    data = request.get_json()
+    try:
+        login_data, error_message = login_upstream(data.get('userid'), data.get('password'))
+        if login_data is None:
+            return jsonify({"status": "error", "stage": "login", "message": error_message})
+    except UpstreamUnavailable as e: return upstream_unavailable(e, stage="login")
+    except requests.RequestException as e: return jsonify({"status": "error", "stage": "login", "message": f"連線錯誤: {str(e)}"}), 500
+    except Exception as e: return jsonify({"status": "error", "stage": "login", "message": f"處理登入回傳失敗: {str(e)}"}), 500
+    try:
+        entry, error_message = load_schedule(login_data, data)
+        if entry is None:
+            return jsonify({"status": "error", "stage": "course", "message": error_message, "data": login_data})
+        session['course_data'] = session_course_data(entry, session.get('course_data'))
+        return jsonify({"status": "success", "data": login_data, **schedule_payload(entry, data.get('format') or request.args.get('format'))})
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e, stage="course", data=login_data)
+    except Exception as e:
+        return jsonify({"status": "error", "stage": "course", "message": f"處理課表數據失敗: {str(e)}", "data": login_data}), 500
+
+@app.route('/api/upstream/stats')
+def upstream_stats():
+    return jsonify(upstream.pool_stats())
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    return jsonify(schedule_cache.stats())
+
+# 全形轉半形的對照表只建一次；節次代號在佔用位元集合與衝堂檢查中會被大量正規化
+SLOT_TRANSLATE_TABLE = str.maketrans("０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺ", "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
 def normalize_slot(slot_str):
     if not slot_str: return ""
-    full_width = "０１２３４５６７８９ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺ"
-    half_width = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-    translate_table = str.maketrans(full_width, half_width)
-    return slot_str.upper().translate(translate_table)
+    return slot_str.upper().translate(SLOT_TRANSLATE_TABLE)
 
 # --- **修改後的 ICS 導出路由** ---
-@app.route('/api/export/ics')
-def export_ics():
-    if 'course_data' not in session:
-        return "錯誤：課表資訊不存在。請先查詢課表。", 400
-
-    course_data = session['course_data']
-    sub_result = course_data['sub_result']
-    temp_grid, _ = process_course_data(sub_result)
-    
-    tz = pytz.timezone('Asia/Taipei')
-    today = datetime.now(tz).date()
-    
+COURSE_TIME_MAPPING = {
+    '1': ("08:10", "09:00"), '2': ("09:10", "10:00"), '3': ("10:10", "11:00"), '4': ("11:10", "12:00"),
+    'E': ("12:10", "13:00"), '5': ("13:10", "14:00"), '6': ("14:10", "15:00"), '7': ("15:10", "16:00"),
+    '8': ("16:10", "17:00"), '9': ("17:10", "18:20"), 'A': ("18:25", "19:15"), 'B': ("19:20", "20:10"),
+    'C': ("20:20", "21:10"), 'D': ("21:15", "22:05")
+}
+TAIPEI = ZoneInfo('Asia/Taipei')
+
+# 手動構建 ICS 內容以確保符合 RFC 5545 規範
+def fold_line(line):
+    """按照 RFC 5545 規範進行 75 字元換行"""
+    if len(line) <= 75:
+        return line
+
+    result = []
+    while len(line) > 75:
+        result.append(line[:75])
+        line = ' ' + line[75:]  # 續行需要空格開頭
+    if line:
+        result.append(line)
+    return '\r\n'.join(result)
+
+def fold_lines(lines):
+    for line in lines:
+        yield fold_line(line)
+
+def semester_range(today):
+    """回傳 (本週一, 學期結束日期)"""
     # 判斷學期結束日期
     current_month = today.month
     if current_month >= 9 or current_month <= 1:  # 上學期 (9月-1月)
         semester_end = date(today.year + (1 if current_month >= 9 else 0), 1, 31)
     else:  # 下學期 (2月-6月)
         semester_end = date(today.year, 6, 20)
-    
+
     # 找到本週一作為起始點
     start_of_this_week = today - timedelta(days=today.weekday())
-
-    course_time_mapping = {
-        '1': ("08:10", "09:00"), '2': ("09:10", "10:00"), '3': ("10:10", "11:00"), '4': ("11:10", "12:00"),
-        'E': ("12:10", "13:00"), '5': ("13:10", "14:00"), '6': ("14:10", "15:00"), '7': ("15:10", "16:00"),
-        '8': ("16:10", "17:00"), '9': ("17:10", "18:20"), 'A': ("18:25", "19:15"), 'B': ("19:20", "20:10"),
-        'C': ("20:20", "21:10"), 'D': ("21:15", "22:05")
-    }
-    
-    # 手動構建 ICS 內容以確保符合 RFC 5545 規範
-    def fold_line(line):
-        """按照 RFC 5545 規範進行 75 字元換行"""
-        if len(line) <= 75:
-            return line
-        
-        result = []
-        while len(line) > 75:
-            result.append(line[:75])
-            line = ' ' + line[75:]  # 續行需要空格開頭
-        if line:
-            result.append(line)
-        return '\r\n'.join(result)
-    
-    ics_lines = [
-        "BEGIN:VCALENDAR",
-        "VERSION:2.0",
-        "PRODID:-//SCU Course Schedule//EN"
-    ]
-    
-    # 計算需要創建事件的週數範圍
+    return start_of_this_week, semester_end
+
+def course_summary(course_text):
+    """清理課程名稱，移除 HTML 標籤和實體字符"""
+    summary_text = course_text.replace('<br>', ' ').replace('<br/>', ' ').strip()
+    summary_text = summary_text.replace('&nbsp;', '').replace('&nbsp', '')
+    return re.sub(r'\s+', ' ', summary_text).strip()
+
+def course_blocks(sub_result, grid):
+    """列出合併後的每個課程區塊：(slot_idx, day_idx, 開始時間, 結束時間, 課程名稱, 原始文字, 課號)"""
+    for i, span in enumerate(grid.spans):
+        if span > 0 and grid.course_ids[i]:
+            slot_idx, day_idx = divmod(i, 7)
+            slot_label = normalize_slot(sub_result[slot_idx].get("slot"))
+            if not slot_label or slot_label not in COURSE_TIME_MAPPING:
+                continue
+
+            end_slot_idx = slot_idx + span - 1
+            end_slot_label = normalize_slot(sub_result[end_slot_idx].get("slot"))
+            if not end_slot_label or end_slot_label not in COURSE_TIME_MAPPING:
+                continue
+
+            summary_text = course_summary(grid.course_texts[i])
+            if not summary_text:
+                continue
+            yield (slot_idx, day_idx, COURSE_TIME_MAPPING[slot_label][0], COURSE_TIME_MAPPING[end_slot_label][1],
+                   summary_text, grid.raw_texts[i], grid.course_ids[i])
+
+def matches_week_parity(raw_text, course_date):
+    """單雙週課程只在對應的 ISO 週次上課"""
+    week_number = course_date.isocalendar()[1]
+    if '單' in raw_text and week_number % 2 == 0:
+        return False
+    elif '雙' in raw_text and week_number % 2 != 0:
+        return False
+    return True
+
+def utc_timestamp(course_date, hm):
+    """台北時間的日期與 HH:MM 轉為 UTC 的 ICS 時間格式"""
+    hour, minute = hm.split(':')
+    local_dt = datetime(course_date.year, course_date.month, course_date.day, int(hour), int(minute), tzinfo=TAIPEI)
+    return local_dt.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def expanded_events(blocks, start_of_this_week, last_day):
+    """每週每堂課各一個 VEVENT"""
     current_week_start = start_of_this_week
-    week_count = 0
-    
-    while current_week_start <= semester_end and week_count < 25:  # 最多25週防止無限循環
-        for slot_idx, row in enumerate(temp_grid):
-            for day_idx, cell in enumerate(row):
-                if cell['span'] > 0 and cell['course_id']:
-                    slot_label = normalize_slot(sub_result[slot_idx].get("slot"))
-                    if not slot_label or slot_label not in course_time_mapping: 
-                        continue
-
-                    start_hm = course_time_mapping[slot_label][0].split(':')
-                    
-                    end_slot_idx = slot_idx + cell['span'] - 1
-                    end_slot_label = normalize_slot(sub_result[end_slot_idx].get("slot"))
-                    if not end_slot_label or end_slot_label not in course_time_mapping: 
-                        continue
-                    end_hm = course_time_mapping[end_slot_label][1].split(':')
-
-                    course_date = current_week_start + timedelta(days=day_idx)
-                    
-                    # 檢查課程日期是否超過學期結束
-                    if course_date > semester_end:
-                        continue
-                    
-                    # 處理單雙週課程
-                    raw_text = cell['raw_text']
-                    week_number = course_date.isocalendar()[1]
-                    
-                    # 跳過不符合單雙週條件的課程
-                    if '單' in raw_text and week_number % 2 == 0:
-                        continue
-                    elif '雙' in raw_text and week_number % 2 != 0:
-                        continue
-                    
-                    begin_dt = tz.localize(datetime(
-                        course_date.year, course_date.month, course_date.day, 
-                        int(start_hm[0]), int(start_hm[1])
-                    ))
-                    end_dt = tz.localize(datetime(
-                        course_date.year, course_date.month, course_date.day, 
-                        int(end_hm[0]), int(end_hm[1])
-                    ))
-                    
-                    # 清理課程名稱，移除 HTML 標籤和實體字符
-                    summary_text = cell['course_text'].replace('<br>', ' ').replace('<br/>', ' ').strip()
-                    summary_text = summary_text.replace('&nbsp;', '').replace('&nbsp', '')
-                    summary_text = re.sub(r'\s+', ' ', summary_text).strip()
-
-                    if not summary_text: 
-                        continue
-                    
-                    # 生成唯一 UID (包含日期和課程資訊)
-                    import uuid
-                    uid = f"{course_date.strftime('%Y%m%d')}-{slot_idx}-{day_idx}-{uuid.uuid4()}"
-                    
-                    # 格式化時間為 UTC
-                    dtstart = begin_dt.astimezone(pytz.UTC).strftime('%Y%m%dT%H%M%SZ')
-                    dtend = end_dt.astimezone(pytz.UTC).strftime('%Y%m%dT%H%M%SZ')
-                    
-                    # 添加事件
-                    ics_lines.extend([
-                        "BEGIN:VEVENT",
-                        fold_line(f"DTSTART:{dtstart}"),
-                        fold_line(f"DTEND:{dtend}"),
-                        fold_line(f"SUMMARY:{summary_text}"),
-                        fold_line(f"UID:{uid}"),
-                        "END:VEVENT"
-                    ])
-        
+    while current_week_start <= last_day:
+        for slot_idx, day_idx, start_hm, end_hm, summary_text, raw_text, course_id in blocks:
+            course_date = current_week_start + timedelta(days=day_idx)
+
+            # 檢查課程日期是否超過學期結束，並跳過不符合單雙週條件的課程
+            if course_date > last_day or not matches_week_parity(raw_text, course_date):
+                continue
+
+            # UID 由日期與課程資訊決定，同一份課表每次匯出的內容完全相同
+            course_hash = hashlib.sha1(f"{course_id}|{summary_text}".encode('utf-8')).hexdigest()[:12]
+            uid = f"{course_date.strftime('%Y%m%d')}-{slot_idx}-{day_idx}-{course_hash}@scu-course-schedule"
+            yield [
+                "BEGIN:VEVENT",
+                f"DTSTART:{utc_timestamp(course_date, start_hm)}",
+                f"DTEND:{utc_timestamp(course_date, end_hm)}",
+                f"SUMMARY:{summary_text}",
+                f"UID:{uid}",
+                "END:VEVENT"
+            ]
+
         # 移動到下一週
         current_week_start += timedelta(weeks=1)
-        week_count += 1
-    
-    ics_lines.append("END:VCALENDAR")
-    ics_content = '\r\n'.join(ics_lines)
-    return Response(
-        ics_content,
-        mimetype="text/calendar",
-        headers={"Content-disposition": "attachment; filename=course_schedule.ics"}
-    )
 
+def parity_exceptions(raw_text, first_date, last_day):
+    """INTERVAL=2 的日期與逐週判斷 ISO 週次單雙的日期不同時 (跨越有 53 週的 ISO 年)，回傳 (EXDATE 日期, RDATE 日期)"""
+    actual, rule = set(), set()
+    course_date = first_date
+    while course_date <= last_day:
+        if matches_week_parity(raw_text, course_date):
+            actual.add(course_date)
+        if (course_date - first_date).days % 14 == 0:
+            rule.add(course_date)
+        course_date += timedelta(weeks=1)
+    return sorted(rule - actual), sorted(actual - rule)
+
+def recurring_events(blocks, start_of_this_week, last_day, semester_end):
+    """每個課程區塊一個 RRULE 重複事件，單雙週課程以 INTERVAL=2 表示，與逐週展開不同的日期以 EXDATE/RDATE 補正"""
+    until = utc_timestamp(last_day, "23:59")
+    for slot_idx, day_idx, start_hm, end_hm, summary_text, raw_text, course_id in blocks:
+        first_date = start_of_this_week + timedelta(days=day_idx)
+        # 第 53 週與下一年第 1 週都是單週，可能連續兩週都不符合
+        while first_date <= last_day and not matches_week_parity(raw_text, first_date):
+            first_date += timedelta(weeks=1)
+        if first_date > last_day:
+            continue
+        exceptions = []
+        interval = ""
+        if '單' in raw_text or '雙' in raw_text:
+            interval = ";INTERVAL=2"
+            exdates, rdates = parity_exceptions(raw_text, first_date, last_day)
+            if exdates:
+                exceptions.append("EXDATE:" + ",".join(utc_timestamp(d, start_hm) for d in exdates))
+            if rdates:
+                exceptions.append("RDATE:" + ",".join(utc_timestamp(d, start_hm) for d in rdates))
+        # UID 只由課程本身決定，重新匯入時行事曆會更新同一組事件而不是重複新增
+        uid_seed = f"{semester_end.isoformat()}|{course_id}|{day_idx}|{slot_idx}|{summary_text}"
+        uid = f"{hashlib.sha1(uid_seed.encode('utf-8')).hexdigest()[:20]}@scu-course-schedule"
+        yield [
+            "BEGIN:VEVENT",
+            f"DTSTART:{utc_timestamp(first_date, start_hm)}",
+            f"DTEND:{utc_timestamp(first_date, end_hm)}",
+            f"RRULE:FREQ=WEEKLY{interval};UNTIL={until}",
+            *exceptions,
+            f"SUMMARY:{summary_text}",
+            f"UID:{uid}",
+            "END:VEVENT"
+        ]
+
+def iter_ics(sub_result, expand=False, today=None, calendar_props=()):
+    """逐段產生本週起到學期結束的 ICS 內容，每個 VEVENT 產生後立即輸出；expand=True 時每週各自展開
+
+    calendar_props 為附加在 VCALENDAR 開頭的屬性行 (訂閱用的名稱、更新間隔等)"""
+    grid = process_course_data(sub_result)
+    start_of_this_week, semester_end = semester_range(today or datetime.now(TAIPEI).date())
+    # 最多25週防止無限循環
+    last_day = min(semester_end, start_of_this_week + timedelta(weeks=25) - timedelta(days=1))
+    blocks = list(course_blocks(sub_result, grid))
+
+    yield '\r\n'.join([
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//SCU Course Schedule//EN",
+        *calendar_props
+    ])
+    if expand:
+        events = expanded_events(blocks, start_of_this_week, last_day)
+    else:
+        events = recurring_events(blocks, start_of_this_week, last_day, semester_end)
+    for event_lines in events:
+        yield '\r\n' + '\r\n'.join(fold_lines(event_lines))
+    yield '\r\nEND:VCALENDAR'
+
+def build_ics(sub_result, expand=False, today=None, calendar_props=()):
+    return ''.join(iter_ics(sub_result, expand, today, calendar_props))
+
+# 輸出格式改變時遞增，讓舊的 ETag 失效
+ICS_FORMAT_VERSION = 2
+
+def ics_validators(course_data, expand, today):
+    """回傳 (ETag, Last-Modified)：ICS 內容只取決於課表、匯出當週的週一與學期結束日期，都相同時不必重新產生"""
+    date_inputs = semester_range(today)
+    start_of_this_week, semester_end = date_inputs
+    seed = json.dumps([ICS_FORMAT_VERSION, expand, start_of_this_week.isoformat(), semester_end.isoformat(), course_data['sub_result']], ensure_ascii=False)
+    etag = hashlib.sha1(seed.encode('utf-8')).hexdigest()[:20]
+    # Last-Modified 與 ETag 取自相同的輸入：學期結束日期 (連帶單雙週的例外日期) 可能在週中改變，
+    # 所以往回找出這組日期開始生效的那一天，只帶 If-Modified-Since 的請求才不會拿到過期的 304
+    effective_from = today
+    while effective_from > start_of_this_week and semester_range(effective_from - timedelta(days=1)) == date_inputs:
+        effective_from -= timedelta(days=1)
+    effective_at = datetime.combine(effective_from, datetime.min.time(), tzinfo=TAIPEI)
+    updated_at = datetime.fromtimestamp(course_data.get('updated_at', 0), timezone.utc)
+    return etag, max(updated_at, effective_at)
+
+def ics_artifact_name(etag):
+    # ETag 已涵蓋格式版本、expand、匯出週與整份課表，內容相同的課表共用同一份
+    return f"ics:{etag}"
+
+def cache_ics_stream(name, chunks):
+    """邊串流邊收集，完整送出後才存進快取；中途斷線不會存入不完整的行事曆"""
+    parts = []
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        parts.append(data)
+        yield data
+    schedule_cache.put_artifact(name, b''.join(parts))
+
+def ics_headers(etag, last_modified):
+    return {"ETag": f'"{etag}"', "Last-Modified": http_date(last_modified), "Cache-Control": "private, no-cache"}
+
+@app.route('/api/export/ics')
+def export_ics():
+    if 'course_data' not in session:
+        return "錯誤：課表資訊不存在。請先查詢課表。", 400
 
+    course_data, expand = session['course_data'], request.args.get('expand') == '1'
+    today = datetime.now(TAIPEI).date()
+    etag, last_modified = ics_validators(course_data, expand, today)
+    headers = ics_headers(etag, last_modified)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+    headers["Content-disposition"] = "attachment; filename=course_schedule.ics"
+    body = schedule_cache.get_artifact(ics_artifact_name(etag))
+    if body is not None:
+        return Response(body, mimetype="text/calendar", headers=headers)
+    # ?expand=1 保留舊的逐週展開格式；以 generator 串流輸出，不在記憶體中組出整份行事曆
+    ics_stream = timed_iter('ics', iter_ics(course_data['sub_result'], expand=expand, today=today))
+    return Response(cache_ics_stream(ics_artifact_name(etag), ics_stream), mimetype="text/calendar", headers=headers)
+
+SUBSCRIPTION_CALENDAR_PROPS = ("X-WR-CALNAME:東吳課表", "X-WR-TIMEZONE:Asia/Taipei",
+                               "REFRESH-INTERVAL;VALUE=DURATION:PT6H", "X-PUBLISHED-TTL:PT6H")
+
+def build_subscription_feed(sub_result):
+    return build_ics(sub_result, calendar_props=SUBSCRIPTION_CALENDAR_PROPS).encode('utf-8')
+
+# 建立 (或更換) 與撤銷訂閱網址；訂閱屬於已通過上游登入的學號
+@app.route('/api/subscription', methods=['POST', 'DELETE'])
+def api_subscription():
+    user_id = session.get('uid')
+    if not user_id:
+        return jsonify({"status": "error", "message": "請先登入"}), 401
+    if request.method == 'DELETE':
+        return jsonify({"status": "success", "revoked": subscription_store.revoke(user_id)})
+    if 'course_data' not in session:
+        return jsonify({"status": "error", "message": "課表資訊不存在。請先查詢課表。"}), 400
+    token = subscription_store.create(user_id)
+    subscription_store.put_feed(user_id, build_subscription_feed(session['course_data']['sub_result']))
+    url = url_for('calendar_feed', token=token, _external=True)
+    return jsonify({"status": "success", "url": url, "webcal": "webcal://" + url.split('://', 1)[1]})
+
+@app.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    # 行事曆 App 輪詢的網址：只讀預先產生的內容，不碰 session 也不呼叫上游
+    etag = subscription_store.current_etag(token)
+    if etag is None:
+        return "Not Found", 404
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, max-age=900"}
+    # 壓縮過的回應帶的是弱 ETag，If-None-Match 依 RFC 9110 用弱比較
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    feed = subscription_store.get_feed(token)
+    if feed is None:
+        return "Not Found", 404
+    etag, body, updated_at = feed
+    headers.update({"ETag": f'"{etag}"', "Last-Modified": http_date(updated_at)})
+    return Response(body, mimetype="text/calendar", headers=headers)
+
+# 只有匯出 SVG/PDF 時才用到，第一次匯出時才載入，不拖慢冷啟動；正式環境由 create_app 在 fork 前先載入
+LAZY_MODULES = ('vector_export',)
+
+def timetable_layout(course_data):
+    import vector_export
+    sub_result, year, semester = course_data['sub_result'], course_data.get('year'), course_data.get('semester')
+    grid = process_course_data(sub_result)
+    title = f"{year} 學年度 第 {semester} 學期" if year else "課表"
+    slots = [(row.get("slot", ""), COURSE_TIME_LABELS[i] if i < len(COURSE_TIME_LABELS) else "") for i, row in enumerate(sub_result)]
+    cells = [(i // 7, i % 7, span, grid.course_texts[i] if grid.has_course(i) else '') for i, span in enumerate(grid.spans) if span > 0]
+    return vector_export.layout_timetable(title, WEEK_DAY_LABELS, slots, cells)
+
+def render_svg(layout):
+    import vector_export
+    return vector_export.render_svg(layout).encode('utf-8')
+
+def render_pdf(layout):
+    import vector_export
+    return vector_export.render_pdf(layout)
+
+VECTOR_FORMATS = {'svg': ('image/svg+xml', render_svg), 'pdf': ('application/pdf', render_pdf)}
+
+@app.route('/api/export/svg', defaults={'fmt': 'svg'})
+@app.route('/api/export/pdf', defaults={'fmt': 'pdf'})
+def export_vector(fmt):
+    if 'course_data' not in session:
+        return "錯誤：課表資訊不存在。請先查詢課表。", 400
+    course_data = session['course_data']
+    # 內容完全由課表決定，ETag 相同時不必重新繪製
+    etag = hashlib.sha1(f"{fmt}|{json.dumps(course_data, sort_keys=True, ensure_ascii=False)}".encode('utf-8')).hexdigest()[:20]
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    mimetype, render = VECTOR_FORMATS[fmt]
+    with metrics.STAGE_LATENCY.time(fmt):
+        body = render(timetable_layout(course_data))
+    headers["Content-disposition"] = f"attachment; filename=course_schedule.{fmt}"
+    return Response(body, mimetype=mimetype, headers=headers)
+
+# --- 多人共同空堂 ---
+MAX_GROUP_MEMBERS = 500
+
+def schedule_occupancy(sub_result, grid, owners=None):
+    """process_course_data 的結果轉為 7×14 的位元集合，跨節課程展開到涵蓋的每一節
+
+    有傳入 owners 時一併記錄每個位元由哪些格子 (grid 索引) 的課程佔用，供衝堂檢查列出課名。
+    """
+    occ = Occupancy()
+    positions = [SLOT_INDEX.get(normalize_slot(row.get("slot"))) for row in sub_result]
+    for i, span in enumerate(grid.spans):
+        if span > 0 and grid.has_course(i):
+            slot_idx, day_idx = divmod(i, 7)
+            parity = week_parity(grid.raw_texts[i])
+            for pos in positions[slot_idx:slot_idx + span]:
+                if pos is not None:
+                    occ.add(day_idx, pos, parity)
+                    if owners is not None:
+                        owners.setdefault(day_idx * NUM_SLOTS + pos, []).append(i)
+    return occ
+
+def exported_occupancy(schedule):
+    """format=json 匯出的課表 (schedule_json 的輸出) 轉為位元集合"""
+    labels = [normalize_slot(str(row[0])) for row in schedule.get('slots', [])]
+    occ = Occupancy()
+    for slot_idx, day_idx, span, _course_id, text in schedule.get('cells', []):
+        if not 0 <= day_idx < 7:
+            raise ValueError(day_idx)
+        parity = week_parity(text)
+        for label in labels[slot_idx:slot_idx + span]:
+            pos = SLOT_INDEX.get(label)
+            if pos is not None:
+                occ.add(day_idx, pos, parity)
+    return occ
+
+def session_schedule():
+    """目前使用者的 (sub_result, grid)：session 內有課表就用它，否則用本瀏覽器登入學號的快取"""
+    course_data = session.get('course_data')
+    if course_data:
+        return course_data['sub_result'], process_course_data(course_data['sub_result'])
+    if session.get('uid'):
+        entry, _ = schedule_cache.lookup(session['uid'])
+        if entry is not None:
+            return entry.sub_result, entry.grid
+    return None
+
+def member_occupancy(member):
+    # 快取只開放給目前 session 自己的學號，其他成員必須上傳自己匯出的課表
+    if member.get('self'):
+        schedule = session_schedule()
+        if schedule is None:
+            raise LookupError("課表資訊不存在。請先查詢課表。")
+        return schedule_occupancy(*schedule)
+    if 'schedule' in member:
+        return exported_occupancy(member['schedule'])
+    if 'sub_result' in member:
+        return schedule_occupancy(member['sub_result'], process_course_data(member['sub_result']))
+    raise ValueError(member)
+
+def slot_mask(days, slots):
+    """days 與 /api/conflicts 相同，以 1-7 表示週一到週日 (對應 SubRESULT 的 day1..day7)"""
+    labels = [normalize_slot(str(label)) for label in slots] if slots else SLOT_LABELS
+    mask = 0
+    for day in map(int, days):
+        if not 1 <= day <= 7:
+            raise ValueError(day)
+        for label in labels:
+            if label in SLOT_INDEX:
+                mask |= bit(day - 1, SLOT_INDEX[label])
+    return mask
+
+@app.route('/api/group/free-time', methods=['POST'])
+def api_group_free_time():
+    data = request.get_json(silent=True) or {}
+    members = data.get('members') or []
+    if not members or len(members) > MAX_GROUP_MEMBERS:
+        return jsonify({"status": "error", "message": f"成員數需介於 1 到 {MAX_GROUP_MEMBERS} 之間"}), 400
+    names, occupancies = [], []
+    for n, member in enumerate(members, 1):
+        try:
+            occupancies.append(member_occupancy(member))
+        except LookupError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        except Exception:
+            return jsonify({"status": "error", "message": f"第 {n} 位成員的課表格式錯誤"}), 400
+        names.append(str(member.get('name') or n))
+    try:
+        min_free = min(max(int(data.get('min_members') or len(occupancies)), 1), len(occupancies))
+        limit = int(data.get('limit') or 20)
+        # 預設只找週一到週五
+        mask = slot_mask(data.get('days') or range(1, 6), data.get('slots'))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "查詢參數格式錯誤"}), 400
+    with metrics.STAGE_LATENCY.time('free_time'):
+        ranked = free_slots(occupancies, min_free, mask)
+    result = []
+    for b, free_odd, free_even in ranked[:limit]:
+        day_idx, pos = position(b)
+        label = SLOT_LABELS[pos]
+        weeks = "every" if min(free_odd, free_even) >= min_free else "odd" if free_odd >= min_free else "even"
+        busy = [name for name, occ in zip(names, occupancies) if (occ.odd | occ.even) >> b & 1]
+        result.append({"day": day_idx + 1, "slot": label, "start": COURSE_TIME_MAPPING[label][0], "end": COURSE_TIME_MAPPING[label][1],
+                       "weeks": weeks, "free": min(free_odd, free_even), "free_odd": free_odd, "free_even": free_even, "busy": busy})
+    return jsonify({"status": "success", "members": len(occupancies), "min_members": min_free, "matches": len(ranked), "slots": result})
+
+# --- 加退選衝堂檢查 ---
+MAX_CONFLICT_CANDIDATES = 5000
+WEEKDAY_NUMBERS = ('1', '2', '3', '4', '5', '6', '7')
+WEEK_PARITY_NAMES = {'odd': 'odd', 'even': 'even', '單': 'odd', '雙': 'even'}
+
+def candidate_slots(value):
+    """節次可以是清單 ["3", "4"] 或字串 "34"、"3,4"、"3-5" (依節次順序展開，3-5 含 E)"""
+    labels = [normalize_slot(str(label)) for label in value] if isinstance(value, list) else \
+        [c for c in normalize_slot(str(value)) if c not in ' ,、']
+    positions = []
+    for n, label in enumerate(labels):
+        if label == '-' and positions and n + 1 < len(labels) and labels[n + 1] in SLOT_INDEX:
+            positions.extend(range(positions[-1] + 1, SLOT_INDEX[labels[n + 1]]))
+            continue
+        if label not in SLOT_INDEX:
+            raise ValueError(f"無法辨識的節次 {label}")
+        positions.append(SLOT_INDEX[label])
+    return positions
+
+def candidate_occupancy(candidate):
+    """候選課程的上課時間：day 為 1 (週一) 到 7 (週日)，與 SubRESULT 的 day1..day7 相同；多個時段放在 times"""
+    parity = WEEK_PARITY_NAMES.get(str(candidate.get('parity') or '')) or week_parity(str(candidate.get('name') or ''))
+    occ = Occupancy()
+    for meeting in candidate.get('times') or [candidate]:
+        day, slots = str(meeting.get('day')), meeting.get('slots')
+        if day not in WEEKDAY_NUMBERS:
+            raise ValueError(f"星期需介於 1 到 7：{day}")
+        if not slots:
+            raise ValueError("缺少節次")
+        for pos in candidate_slots(slots):
+            occ.add(int(day) - 1, pos, parity)
+    return occ
+
+def conflict_details(odd_hits, even_hits, owners, grid):
+    conflicts = []
+    for b in iter_bits(odd_hits | even_hits):
+        day_idx, pos = position(b)
+        weeks = "every" if (odd_hits & even_hits) >> b & 1 else "odd" if odd_hits >> b & 1 else "even"
+        for i in owners[b]:
+            conflicts.append({"day": day_idx + 1, "slot": SLOT_LABELS[pos], "weeks": weeks,
+                              "courseId": grid.course_ids[i], "course": course_summary(grid.course_texts[i])})
+    return conflicts
+
+@app.route('/api/conflicts', methods=['POST'])
+def api_conflicts():
+    data = request.get_json(silent=True) or {}
+    candidates = data.get('candidates') or []
+    if not isinstance(candidates, list) or len(candidates) > MAX_CONFLICT_CANDIDATES:
+        return jsonify({"status": "error", "message": f"候選課程最多 {MAX_CONFLICT_CANDIDATES} 筆"}), 400
+    schedule = session_schedule()
+    if schedule is None:
+        return jsonify({"status": "error", "message": "課表資訊不存在。請先查詢課表。"}), 400
+    sub_result, grid = schedule
+    # 目前課表只算一次位元集合，每個候選課程只需兩次 AND
+    owners = {}
+    current = schedule_occupancy(sub_result, grid, owners)
+    results, conflicting = [], 0
+    with metrics.STAGE_LATENCY.time('conflicts'):
+        for n, candidate in enumerate(candidates):
+            candidate_id = candidate.get('id', n) if isinstance(candidate, dict) else n
+            try:
+                odd_hits, even_hits = current.overlap(candidate_occupancy(candidate))
+            except ValueError as e:
+                results.append({"id": candidate_id, "error": str(e)})
+                continue
+            except (AttributeError, TypeError):
+                results.append({"id": candidate_id, "error": "候選課程格式錯誤"})
+                continue
+            conflicts = conflict_details(odd_hits, even_hits, owners, grid) if odd_hits | even_hits else []
+            conflicting += bool(conflicts)
+            results.append({"id": candidate_id, "conflict": bool(conflicts), "conflicts": conflicts})
+    return jsonify({"status": "success", "checked": len(results), "conflicting": conflicting, "results": results})
+
+def create_app():
+    """正式環境 (gunicorn -c gunicorn.conf.py wsgi:app) 的 app；路由與共用狀態都在模組層級，這裡只套用正式環境的設定"""
+    if not app.config.get('PRODUCTION'):
+        app.config['PRODUCTION'] = True
+        # 部署在反向代理後面，訂閱網址等外部網址要依 X-Forwarded-Proto/Host 產生
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+        if 'SECRET_KEY' not in os.environ:
+            app.logger.warning("SECRET_KEY 未設定，使用啟動時隨機產生的金鑰")
+        # gunicorn preload 時在 master 載入，worker 以 copy-on-write 共用，不必各自在第一次匯出時載入
+        for name in LAZY_MODULES:
+            importlib.import_module(name)
+    return app
+
+# 本機開發用；正式環境請用 gunicorn (見 gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,247 @@
+"""非同步 (ASGI) 服務模式
+
+/api/login、/api/course、/api/schedule 與 /api/export/ics 在這裡以 asyncio 實作，
+對校務系統的呼叫改由 aiohttp 非同步等待，單一行程即可同時持有數百個進行中的上游請求；
+其餘路由 (首頁等) 直接交給原本的 Flask app。
+
+啟動方式：
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Session 與 Flask 共用同一個伺服器端 store 與 cookie，同步與非同步模式可以混用。
+session、課表快取與訂閱的 store 都是同步的 (sqlite 後端會等檔案鎖)，一律在執行緒池中呼叫，不卡住事件迴圈。
+需要額外安裝 starlette、uvicorn、a2wsgi、aiohttp。
+"""
+import asyncio
+import contextlib
+import functools
+import time
+from datetime import datetime
+
+import aiohttp
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import is_resource_modified
+
+import app as flask_module
+import metrics
+from compression import CompressionASGIMiddleware, enabled_from_env
+from app import (BASE_URL, TAIPEI, ScheduleCache, cache_ics_stream, course_login_params, ics_artifact_name, ics_headers,
+                 ics_validators, iter_ics, lookup_cached_schedule, parse_course_response, parse_login_response, schedule_cache,
+                 schedule_payload, session_course_data, session_store)
+from session_store import new_session_id
+from upstream import AsyncUpstreamClient, UpstreamUnavailable
+
+flask_app = flask_module.app
+upstream = AsyncUpstreamClient.from_env(BASE_URL)
+# /metrics 仍由 Flask 輸出，上游指標要改報這個 client，同步的 client 在 ASGI 模式下不會被使用
+flask_module.metrics_upstream = upstream
+# 背景更新的 task 需要保留參考，否則可能在完成前被回收
+_background_tasks = set()
+
+
+# --- 與 Flask 共用的伺服器端 session ---
+_cookie_name = flask_app.config['SESSION_COOKIE_NAME']
+
+
+class AsyncSession(dict):
+    # session id 放在屬性上而不是 dict 裡，以免被寫進 store
+    sid = None
+    previous_sid = None
+
+    def regenerate(self):
+        """與 ServerSideSession.regenerate 相同：登入時換發 session id，舊 id 在存檔時刪除"""
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = new_session_id()
+
+
+async def load_session(request):
+    sid = request.cookies.get(_cookie_name)
+    data = await run_in_threadpool(session_store.get, sid) if sid else None
+    session_data = AsyncSession(data or {})
+    session_data.sid = sid if data is not None else new_session_id()
+    return session_data
+
+
+def store_session(session_data):
+    if session_data.previous_sid is not None:
+        session_store.delete(session_data.previous_sid)
+    session_store.set(session_data.sid, session_data)
+
+
+async def save_session(response, session_data):
+    await run_in_threadpool(store_session, session_data)
+    response.set_cookie(_cookie_name, session_data.sid, httponly=True, path='/',
+                        secure=flask_app.config['SESSION_COOKIE_SECURE'],
+                        samesite=flask_app.config['SESSION_COOKIE_SAMESITE'] or 'lax')
+    return response
+
+
+def instrumented(route):
+    """與 Flask 的 before/after_request 記錄相同的指標；掛在 Mount 底下的 Flask 路由由 Flask 自己記錄"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            start = time.perf_counter()
+            with metrics.HTTP_IN_FLIGHT.track_inprogress():
+                response = await handler(request)
+            metrics.HTTP_REQUESTS.inc(route, request.method, response.status_code)
+            metrics.HTTP_LATENCY.observe(route, value=time.perf_counter() - start)
+            # StreamingResponse 沒有 body，大小由 metrics.count_bytes 在傳送完時記錄
+            if hasattr(response, 'body'):
+                metrics.HTTP_RESPONSE_SIZE.observe(route, value=len(response.body))
+            return response
+        return wrapper
+    return decorator
+
+
+async def fetch_schedule(login_params, session_uid):
+    course_data = await upstream.call("CourseTable", **login_params)
+    # 解析後會寫入課表快取並更新訂閱的行事曆
+    return await run_in_threadpool(parse_course_response, course_data, login_params['api_loginID'], session_uid)
+
+
+async def revalidate_schedule(key, login_params, session_uid):
+    try:
+        await fetch_schedule(login_params, session_uid)
+    except Exception:
+        pass
+    finally:
+        await run_in_threadpool(schedule_cache.end_refresh, key)
+
+
+async def load_schedule(request, login_data, options, session_data):
+    login_params = course_login_params(login_data)
+    session_uid = session_data.get('uid')
+    entry, state = await run_in_threadpool(lookup_cached_schedule, login_data, options, session_uid,
+                                           request.query_params.get('refresh') == '1')
+    if entry is None:
+        return await fetch_schedule(login_params, session_uid)
+    if state == ScheduleCache.STALE and await run_in_threadpool(schedule_cache.begin_refresh, entry.key):
+        task = asyncio.create_task(revalidate_schedule(entry.key, login_params, session_uid))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return entry, None
+
+
+async def login_upstream(userid, password, session_data):
+    login_data, error_message = parse_login_response(await upstream.call("Login", userid=userid, password=password))
+    if login_data is not None:
+        session_data.regenerate()
+        session_data['uid'] = login_data['userId']
+    return login_data, error_message
+
+
+def upstream_unavailable(e, **extra):
+    return JSONResponse({"status": "error", "message": str(e), **extra}, 503, headers={"Retry-After": str(e.retry_after)})
+
+
+@instrumented('/api/login')
+async def api_login(request):
+    data = await request.json()
+    session_data = await load_session(request)
+    try:
+        login_data, error_message = await login_upstream(data.get('userid'), data.get('password'), session_data)
+        if login_data is None:
+            return JSONResponse({"status": "error", "message": error_message})
+        return await save_session(JSONResponse({"status": "success", "message": "登入成功", "data": login_data}), session_data)
+    except UpstreamUnavailable as e: return upstream_unavailable(e)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e: return JSONResponse({"status": "error", "message": f"連線錯誤: {str(e)}"}, 500)
+    except Exception as e: return JSONResponse({"status": "error", "message": f"處理登入回傳失敗: {str(e)}"}, 500)
+
+
+@instrumented('/api/course')
+async def api_course(request):
+    data = await request.json()
+    if not all(data.get(k) for k in ('sessionID', 'userId', 'sessionCode', 'name', 'unit')):
+        return JSONResponse({"status": "error", "message": "缺少必要的登入資訊來獲取課表"}, 400)
+    session_data = await load_session(request)
+    try:
+        entry, error_message = await load_schedule(request, data, data, session_data)
+        if entry is None:
+            return JSONResponse({"status": "error", "message": error_message})
+        session_data['course_data'] = session_course_data(entry, session_data.get('course_data'))
+        # 格線 HTML 會讀寫課表快取的 artifact
+        payload = await run_in_threadpool(schedule_payload, entry, data.get('format') or request.query_params.get('format'))
+        return await save_session(JSONResponse({"status": "success", **payload}), session_data)
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e)
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": f"處理課表數據失敗: {str(e)}"}, 500)
+
+
+@instrumented('/api/schedule')
+async def api_schedule(request):
+    data = await request.json()
+    session_data = await load_session(request)
+    try:
+        login_data, error_message = await login_upstream(data.get('userid'), data.get('password'), session_data)
+        if login_data is None:
+            return JSONResponse({"status": "error", "stage": "login", "message": error_message})
+    except UpstreamUnavailable as e: return upstream_unavailable(e, stage="login")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e: return JSONResponse({"status": "error", "stage": "login", "message": f"連線錯誤: {str(e)}"}, 500)
+    except Exception as e: return JSONResponse({"status": "error", "stage": "login", "message": f"處理登入回傳失敗: {str(e)}"}, 500)
+    try:
+        entry, error_message = await load_schedule(request, login_data, data, session_data)
+        if entry is None:
+            return await save_session(JSONResponse({"status": "error", "stage": "course", "message": error_message, "data": login_data}), session_data)
+        session_data['course_data'] = session_course_data(entry, session_data.get('course_data'))
+        # 格線 HTML 會讀寫課表快取的 artifact
+        payload = await run_in_threadpool(schedule_payload, entry, data.get('format') or request.query_params.get('format'))
+        return await save_session(JSONResponse({"status": "success", "data": login_data, **payload}), session_data)
+    except UpstreamUnavailable as e:
+        return await save_session(upstream_unavailable(e, stage="course", data=login_data), session_data)
+    except Exception as e:
+        return await save_session(JSONResponse({"status": "error", "stage": "course", "message": f"處理課表數據失敗: {str(e)}", "data": login_data}, 500), session_data)
+
+
+@instrumented('/api/export/ics')
+async def export_ics(request):
+    session_data = await load_session(request)
+    if 'course_data' not in session_data:
+        return Response("錯誤：課表資訊不存在。請先查詢課表。", 400, media_type="text/html")
+    course_data, expand = session_data['course_data'], request.query_params.get('expand') == '1'
+    today = datetime.now(TAIPEI).date()
+    etag, last_modified = ics_validators(course_data, expand, today)
+    headers = ics_headers(etag, last_modified)
+    conditions = {"HTTP_IF_NONE_MATCH": request.headers.get('if-none-match'),
+                  "HTTP_IF_MODIFIED_SINCE": request.headers.get('if-modified-since')}
+    if not is_resource_modified(conditions, etag=etag, last_modified=last_modified):
+        return Response(status_code=304, headers=headers)
+    headers["Content-disposition"] = "attachment; filename=course_schedule.ics"
+    body = await run_in_threadpool(schedule_cache.get_artifact, ics_artifact_name(etag))
+    if body is not None:
+        return Response(body, media_type="text/calendar", headers=headers)
+    # StreamingResponse 會在執行緒池中逐段取出同步 generator，不會卡住事件迴圈
+    ics_stream = cache_ics_stream(ics_artifact_name(etag), metrics.timed_iter('ics', iter_ics(course_data['sub_result'], expand, today)))
+    ics_stream = metrics.count_bytes('/api/export/ics', ics_stream)
+    return StreamingResponse(ics_stream, media_type="text/calendar", headers=headers)
+
+
+@instrumented('/api/upstream/stats')
+async def upstream_stats(request):
+    return JSONResponse(upstream.pool_stats())
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    yield
+    await upstream.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/login', api_login, methods=['POST']),
+        Route('/api/course', api_course, methods=['POST']),
+        Route('/api/schedule', api_schedule, methods=['POST']),
+        Route('/api/export/ics', export_ics),
+        Route('/api/upstream/stats', upstream_stats),
+        Mount('/', WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+    middleware=[Middleware(CompressionASGIMiddleware, **CompressionASGIMiddleware.env_options())] if enabled_from_env() else [],
+)
@@ -0,0 +1,58 @@
+"""以內容雜湊網址提供 build_assets.py 產生的靜態資源
+
+啟動時讀入 ASSETS_DIR (預設 ./assets) 下的檔案，每個檔案預先壓縮並對應到
+/assets/<名稱>.<雜湊>.<副檔名>；內容改變網址就會改變，因此可以設成一年且 immutable 的快取。
+目錄不存在或檔案缺少時 url() 回傳 fallback，讓未執行建置的開發環境仍可使用。
+壓縮結果快取在 <ASSETS_DIR>/.precompressed/，由 build_assets.py 在建置時產生。
+
+要下載與產生的檔案清單也定義在這裡，app 不必為了這幾個常數載入建置腳本。
+"""
+import mimetypes
+import os
+
+from precompressed import PrecompressedBody
+
+ASSET_PREFIX = '/assets/'
+ONE_YEAR = 365 * 24 * 3600
+MIMETYPES = {'.js': 'text/javascript', '.woff2': 'font/woff2', '.css': 'text/css'}
+CACHE_DIRNAME = '.precompressed'
+
+# 與原本 CDN 上使用的版本相同
+SCRIPTS = {
+    'html2canvas.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/html2canvas/1.4.1/html2canvas.min.js',
+    'jspdf.umd.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/jspdf/2.5.1/jspdf.umd.min.js',
+}
+FONT_OUTPUT = 'NotoSansTC-subset.woff2'
+
+
+class AssetBundle:
+    def __init__(self, directory):
+        self.directory = directory
+        self.cache_dir = os.path.join(directory, CACHE_DIRNAME)
+        self.urls = {}
+        self.bodies = {}
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            stem, ext = os.path.splitext(name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            mimetype = MIMETYPES.get(ext) or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            body = PrecompressedBody(data, mimetype, max_age=ONE_YEAR, immutable=True, cache_dir=self.cache_dir)
+            hashed = f"{stem}.{body.digest[:12]}{ext}"
+            self.urls[name] = ASSET_PREFIX + hashed
+            self.bodies[hashed] = body
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get('ASSETS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')))
+
+    def url(self, name, fallback=None):
+        return self.urls.get(name, fallback)
+
+    def get(self, hashed_name):
+        """依帶雜湊的檔名取得 PrecompressedBody；舊版本的雜湊不再提供"""
+        return self.bodies.get(hashed_name)
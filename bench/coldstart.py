@@ -0,0 +1,111 @@
+"""冷啟動時間：import app 的耗時分布，以及行程啟動到第一個 GET / 回應 200 的時間
+
+Render 免費方案閒置後會停機，下一個使用者要等服務重新啟動；這裡量的就是那段等待。
+
+    import app     以 python -X importtime 列出自身耗時最多的模組，並量測 import app 的牆鐘時間
+    首次回應       以 bench/concurrency.py 的各模式啟動服務，從 Popen 到 GET / 回應 200 的時間
+
+任何模式的中位數超過 --target-ms 時以非零狀態結束，可放進部署前的檢查。
+
+用法：
+    python bench/coldstart.py --runs 5 --target-ms 1500
+    python bench/coldstart.py --modes production --assets-dir assets --top 20
+"""
+import argparse
+import http.client
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+from concurrency import MODE_ENV, MODES, ROOT, free_port
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+
+
+def import_profile(env, top):
+    """python -X importtime 的輸出 -> (app 的累計微秒, 自身耗時最多的 top 個 [(微秒, 模組)])"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+    rows, total = [], 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(self_us), name.strip()))
+        if name.strip() == 'app':
+            total = int(cumulative_us)
+    rows.sort(reverse=True)
+    return total, rows[:top]
+
+
+def import_seconds(env, runs):
+    return [float(subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT, env=env, capture_output=True,
+                                 text=True, check=True).stdout) for _ in range(runs)]
+
+
+def first_response(mode, env, timeout=30):
+    """啟動一次服務，回傳從 Popen 到 GET / 回應 200 的秒數"""
+    port = free_port()
+    env = {**env, "PORT": str(port), **MODE_ENV.get(mode, {})}
+    cmd = [part.format(port=port) for part in MODES[mode]]
+    start = time.perf_counter()
+    # app.py 以 debug 模式啟動時會多一個 reloader 子行程，所以整個行程群組一起結束
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+                conn.request('GET', '/', headers={"Accept-Encoding": "br, gzip"})
+                status = conn.getresponse().status
+                conn.close()
+                if status == 200:
+                    return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.005)
+        raise RuntimeError(f"{mode} did not serve / within {timeout}s")
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='flask,production')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='列出自身 import 耗時最多的模組數')
+    parser.add_argument('--target-ms', type=float, default=1500, help='首次回應中位數的上限')
+    parser.add_argument('--assets-dir', help='ASSETS_DIR；預設使用 app 的預設目錄')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.assets_dir:
+        env['ASSETS_DIR'] = os.path.abspath(args.assets_dir)
+    # 第一次 import 可能要編譯 .pyc、寫入預先壓縮的快取，不計入量測
+    import_seconds(env, 1)
+
+    total, rows = import_profile(env, args.top)
+    print(f"import app (cumulative, -X importtime): {total / 1000:.1f} ms")
+    for self_us, name in rows:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+    seconds = import_seconds(env, args.runs)
+    print(f"import app wall time: median {statistics.median(seconds) * 1000:.1f} ms, max {max(seconds) * 1000:.1f} ms")
+
+    failed = []
+    for mode in args.modes.split(','):
+        seconds = [first_response(mode, env) for _ in range(args.runs)]
+        median = statistics.median(seconds) * 1000
+        print(f"{mode:10s} first GET /: median {median:.1f} ms, max {max(seconds) * 1000:.1f} ms (target {args.target_ms:.0f} ms)")
+        if median > args.target_ms:
+            failed.append(mode)
+    if failed:
+        print(f"over target: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""同步 (Flask) 與非同步 (ASGI) 服務模式的併發比較
+
+啟動固定延遲的假 jsonApi.php (bench/fake_portal.py)，再分別以下列方式啟動本服務並用 SCU_BASE_URL 指向假上游：
+    flask     python app.py (目前 render.yaml 的啟動方式)
+    gunicorn  gunicorn -w 1 app:app (同步 worker)
+    production  gunicorn -c gunicorn.conf.py wsgi:app (render.yaml 的啟動方式，session 與課表快取用 sqlite 讓多個 worker 共用)
+    asgi      uvicorn asgi:app
+
+對每種模式以固定併發數送出 POST /api/login，量測吞吐量與延遲分位數。
+
+用法：
+    python bench/concurrency.py --concurrency 200 --requests 1000 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    'flask': [sys.executable, 'app.py'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', '127.0.0.1:{port}', 'app:app'],
+    'production': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning'],
+}
+
+# 各模式額外的環境變數
+MODE_ENV = {
+    'production': {"SESSION_BACKEND": "sqlite", "SUBSCRIPTION_BACKEND": "sqlite",
+                   "SESSION_SQLITE_PATH": os.path.join(tempfile.gettempdir(), f"scu-bench-{os.getpid()}-sessions.sqlite3"),
+                   "SUBSCRIPTION_SQLITE_PATH": os.path.join(tempfile.gettempdir(), f"scu-bench-{os.getpid()}-subscriptions.sqlite3"),
+                   "SCHEDULE_CACHE_BACKEND": "sqlite",
+                   "SCHEDULE_CACHE_SQLITE_PATH": os.path.join(tempfile.gettempdir(), f"scu-bench-{os.getpid()}-schedules.sqlite3")},
+}
+
+
+def start_slow_portal(latency):
+    """在獨立行程啟動假上游，避免與壓測用戶端搶同一個 GIL"""
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bench', 'fake_portal.py'), '--port', str(port),
+                             '--latency', str(latency)], stdout=subprocess.DEVNULL)
+    wait_ready(port)
+    return proc, f"http://127.0.0.1:{port}/portal"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+async def drive(port, concurrency, total):
+    latencies, errors = [], 0
+    remaining = total
+    url = f"http://127.0.0.1:{port}/api/login"
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as client:
+        async def worker():
+            nonlocal errors, remaining
+            while remaining > 0:
+                remaining -= 1
+                t0 = time.perf_counter()
+                try:
+                    async with client.post(url, json={"userid": "u", "password": "p"}) as r:
+                        result = await r.json(content_type=None)
+                        if r.status != 200 or result.get('status') != 'success':
+                            errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    errors += 1
+                latencies.append(time.perf_counter() - t0)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": total, "errors": errors, "seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def run_mode(mode, base_url, args):
+    port = free_port()
+    env = {**os.environ, "SCU_BASE_URL": base_url, "PORT": str(port), **MODE_ENV.get(mode, {})}
+    cmd = [part.format(port=port) for part in MODES[mode]]
+    # app.py 以 debug 模式啟動時會多一個 reloader 子行程，所以整個行程群組一起結束
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        wait_ready(port)
+        return asyncio.run(drive(port, args.concurrency, args.requests))
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='flask,gunicorn,production,asgi')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.5, help='假上游每次回應的延遲秒數')
+    args = parser.parse_args()
+
+    portal, base_url = start_slow_portal(args.latency)
+    results = {}
+    try:
+        for mode in args.modes.split(','):
+            results[mode] = run_mode(mode, base_url, args)
+            print(f"{mode:9s} {json.dumps(results[mode], ensure_ascii=False)}", flush=True)
+    finally:
+        portal.terminate()
+    return results
+
+
+if __name__ == '__main__':
+    main()
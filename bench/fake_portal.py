@@ -0,0 +1,147 @@
+"""本機假的校務系統 jsonApi.php，用於壓力測試
+
+以 asyncio 實作的最小 HTTP/1.1 伺服器 (支援 keep-alive)，處理 Login 與 CourseTable 兩個 libName。
+可以設定延遲分布、錯誤率與課表大小：
+
+    --latency      每次回應前的延遲，格式：
+                       0.5                固定 0.5 秒
+                       uniform:0.1,0.8    均勻分布
+                       lognormal:0.3,0.6  對數常態，中位數 0.3 秒、sigma 0.6
+                       exp:0.3            指數分布，平均 0.3 秒
+    --error-rate   回傳 HTTP 500 的比例
+    --fail-rate    回傳 {"status": "error"} 的比例
+    --payload      CourseTable 的課表：dense / sparse / dense_alternating (見 bench/fixtures.py)
+    --slots        課表節數 (預設 14)
+
+用法：
+    python bench/fake_portal.py --port 8765 --latency lognormal:0.3,0.6 --error-rate 0.01
+    SCU_BASE_URL=http://127.0.0.1:8765/portal python app.py
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import course_table_response, synthetic_sub_result  # noqa: E402
+
+
+def parse_latency(spec):
+    """把延遲設定轉成回傳秒數的函式"""
+    kind, _, params = str(spec).partition(':')
+    if not params:
+        value = float(kind)
+        return lambda rnd: value
+    values = [float(v) for v in params.split(',')]
+    if kind == 'uniform':
+        low, high = values
+        return lambda rnd: rnd.uniform(low, high)
+    if kind == 'lognormal':
+        median, sigma = values
+        return lambda rnd: rnd.lognormvariate(math.log(median), sigma)
+    if kind == 'exp':
+        mean, = values
+        return lambda rnd: rnd.expovariate(1 / mean)
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+class FakePortal:
+    def __init__(self, latency='0', error_rate=0.0, fail_rate=0.0, payload='dense', slots=14, seed=None):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.rnd = random.Random(seed)
+        # 課表內容固定，先序列化好，壓測時量到的是延遲而不是假上游的 CPU
+        self.course_table = course_table_response(synthetic_sub_result(payload, seed=0, num_slots=slots))
+        self.counts = {}
+
+    def handle(self, form):
+        lib_name = form.get('libName', '')
+        self.counts[lib_name] = self.counts.get(lib_name, 0) + 1
+        if self.fail_rate and self.rnd.random() < self.fail_rate:
+            return {"status": "error", "message": "系統忙碌中，請稍後再試"}
+        if lib_name == 'Login':
+            userid = form.get('userid', 'student')
+            return {"status": "success", "message": {"sessionID": f"S-{userid}", "userId": userid, "sessionCode": "C",
+                                                     "name": "測試學生", "unit": "資管一A"}}
+        if lib_name == 'CourseTable':
+            return self.course_table
+        return {"status": "error", "message": f"unknown libName {lib_name}"}
+
+    async def respond(self, form):
+        delay = self.latency(self.rnd)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.rnd.random() < self.error_rate:
+            return 500, {"status": "error", "message": "Internal Server Error"}
+        return 200, self.handle(form)
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                form = {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+                status, payload = await self.respond(form)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                             f"Content-Type: application/json; charset=utf-8\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(portal, host, port, ready=None):
+    server = await asyncio.start_server(portal.serve_connection, host, port, backlog=2048)
+    if ready is not None:
+        ready(server.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', default='0', help='延遲分布，見模組說明')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='回傳 HTTP 500 的比例')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='回傳 status=error 的比例')
+    parser.add_argument('--payload', default='dense', choices=['dense', 'sparse', 'dense_alternating'])
+    parser.add_argument('--slots', type=int, default=14)
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def portal_from_args(args):
+    return FakePortal(latency=args.latency, error_rate=args.error_rate, fail_rate=args.fail_rate,
+                      payload=args.payload, slots=args.slots, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    portal = portal_from_args(args)
+    print(f"fake portal: SCU_BASE_URL=http://{args.host}:{args.port}/portal", flush=True)
+    asyncio.run(serve(portal, args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
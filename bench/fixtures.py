@@ -0,0 +1,65 @@
+"""合成的 CourseTable SubRESULT，結構與校務系統回傳相同
+
+每一列是一節課 (slot)，含 day1..day7 的課程文字與 day1Courid..day7Courid 課號。
+課程文字沿用校務系統的格式：課名、<br/>、教室與教師，單雙週課程在課名後標 (單)/(雙)。
+"""
+import random
+
+SLOTS = ['1', '2', '3', '4', 'E', '5', '6', '7', '8', '9', 'A', 'B', 'C', 'D']
+
+COURSE_NAMES = ['微積分', '經濟學原理', '會計學', '程式設計', '資料結構', '統計學', '英文(一)', '國文',
+                '體育', '計算機概論', '民法總則', '商事法', '社會學', '心理學導論', '日文(一)', '管理學']
+ROOMS = ['R0101', 'R0205', 'B312', 'D0410', 'H202', 'F501', '第一體育館', 'G103']
+TEACHERS = ['王老師', '李老師', '陳老師', '林老師', '張老師', '黃老師']
+
+DENSITY = {'dense': 0.75, 'sparse': 0.2}
+
+
+def empty_row(slot):
+    row = {'slot': slot}
+    for day in range(1, 8):
+        row[f'day{day}'], row[f'day{day}Courid'] = '', ''
+    return row
+
+
+def course_text(rnd, name, parity=''):
+    return f"{name}{parity}<br/>{rnd.choice(ROOMS)}&nbsp;{rnd.choice(TEACHERS)}"
+
+
+def synthetic_sub_result(kind='dense', seed=0, num_slots=14, alternating=0.15, max_span=3):
+    """產生一份課表：kind 為 dense/sparse，課程以 1..max_span 節連堂放置，部分課程為單雙週"""
+    rnd = random.Random(seed)
+    rows = [empty_row(SLOTS[i % len(SLOTS)]) for i in range(num_slots)]
+    density = DENSITY[kind]
+    next_id = 1000
+    # 週六、週日幾乎不排課，與實際課表相近
+    for day in range(1, 8):
+        day_density = density if day <= 5 else density * 0.1
+        slot_idx = 0
+        while slot_idx < num_slots:
+            if rnd.random() >= day_density:
+                slot_idx += 1
+                continue
+            span = min(rnd.randint(1, max_span), num_slots - slot_idx)
+            parity = ''
+            if rnd.random() < alternating:
+                parity = rnd.choice(['(單)', '(雙)'])
+            text = course_text(rnd, rnd.choice(COURSE_NAMES), parity)
+            course_id = str(next_id)
+            next_id += 1
+            for k in range(slot_idx, slot_idx + span):
+                rows[k][f'day{day}'], rows[k][f'day{day}Courid'] = text, course_id
+            slot_idx += span
+    return rows
+
+
+def course_table_response(sub_result, year=114, semester=1):
+    """包成 jsonApi.php CourseTable 的回傳格式"""
+    return {"status": "success", "message": {"SubRESULT": sub_result, "time": f" {year} 學年度 {semester} 學期"}}
+
+
+FIXTURES = {
+    'dense': lambda: synthetic_sub_result('dense', seed=1),
+    'sparse': lambda: synthetic_sub_result('sparse', seed=2),
+    'dense_alternating': lambda: synthetic_sub_result('dense', seed=3, alternating=0.6),
+}
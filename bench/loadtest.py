@@ -0,0 +1,166 @@
+"""端到端壓力測試：/api/login → /api/course → /api/export/ics
+
+每個虛擬使用者有自己的 cookie (session)，依序走完登入、查課表、匯出 ICS 的流程並重複，
+直到跑滿 --duration 秒或 --flows 次。回報整體吞吐量與各步驟的 p50/p95/p99 延遲。
+
+可以對已經在執行的服務壓測：
+    python bench/fake_portal.py --port 8765 --latency lognormal:0.3,0.6 &
+    SCU_BASE_URL=http://127.0.0.1:8765/portal uvicorn asgi:app --port 8000 &
+    python bench/loadtest.py --target http://127.0.0.1:8000 --concurrency 100 --duration 30
+
+或讓腳本自己啟動假上游與服務 (模式同 bench/concurrency.py：flask / gunicorn / production / asgi)：
+    python bench/loadtest.py --spawn asgi --latency lognormal:0.3,0.6 --error-rate 0.01 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_portal  # noqa: E402
+from concurrency import MODE_ENV, MODES, ROOT, free_port, percentile, wait_ready  # noqa: E402
+
+STEPS = ('login', 'course', 'ics', 'flow')
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+        self.bytes = 0
+
+    def record(self, step, seconds, ok):
+        self.latencies[step].append(seconds)
+        if not ok:
+            self.errors[step] += 1
+
+    def summary(self, elapsed):
+        report = {"seconds": round(elapsed, 3), "flows": len(self.latencies['flow']),
+                  "flows_per_s": round(len(self.latencies['flow']) / elapsed, 2) if elapsed else 0.0,
+                  "requests_per_s": round(sum(len(self.latencies[s]) for s in STEPS[:3]) / elapsed, 2) if elapsed else 0.0,
+                  "response_bytes": self.bytes, "steps": {}}
+        for step in STEPS:
+            values = sorted(self.latencies[step])
+            report["steps"][step] = {
+                "count": len(values), "errors": self.errors[step],
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+            }
+        return report
+
+
+async def timed(stats, step, coro_factory):
+    t0 = time.perf_counter()
+    try:
+        ok, result = await coro_factory()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        ok, result = False, None
+    stats.record(step, time.perf_counter() - t0, ok)
+    return ok, result
+
+
+async def virtual_user(vu, base, connector, stats, deadline, budget):
+    # 每個虛擬使用者各自的 cookie jar；目標常是 IP 位址，需要 unsafe=True 才會保存 cookie
+    jar = aiohttp.CookieJar(unsafe=True)
+    async with aiohttp.ClientSession(connector=connector, connector_owner=False, cookie_jar=jar,
+                                     timeout=aiohttp.ClientTimeout(total=120)) as client:
+        async def post_json(path, payload):
+            async with client.post(f"{base}{path}", json=payload) as r:
+                body = await r.read()
+                stats.bytes += len(body)
+                result = json.loads(body)
+                return r.status == 200 and result.get('status') == 'success', result
+
+        async def get_ics():
+            async with client.get(f"{base}/api/export/ics") as r:
+                body = await r.read()
+                stats.bytes += len(body)
+                return r.status == 200 and body.startswith(b'BEGIN:VCALENDAR'), None
+
+        while time.perf_counter() < deadline and budget[0] > 0:
+            budget[0] -= 1
+            t0 = time.perf_counter()
+            ok, login = await timed(stats, 'login', lambda: post_json('/api/login', {"userid": f"s{vu:05d}", "password": "p"}))
+            if ok:
+                ok, _ = await timed(stats, 'course', lambda: post_json('/api/course', login['data']))
+            if ok:
+                ok, _ = await timed(stats, 'ics', get_ics)
+            stats.record('flow', time.perf_counter() - t0, ok)
+
+
+async def run_load(base, concurrency, duration, flows):
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    deadline = time.perf_counter() + duration
+    budget = [flows if flows else float('inf')]
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(virtual_user(vu, base, connector, stats, deadline, budget) for vu in range(concurrency)))
+    finally:
+        await connector.close()
+    return stats.summary(time.perf_counter() - start)
+
+
+def spawn(mode, args):
+    """啟動假上游與指定模式的服務，回傳 (base_url, 要結束的行程)"""
+    portal_port, app_port = free_port(), free_port()
+    portal_cmd = [sys.executable, os.path.join(ROOT, 'bench', 'fake_portal.py'), '--port', str(portal_port),
+                  '--latency', args.latency, '--error-rate', str(args.error_rate), '--fail-rate', str(args.fail_rate),
+                  '--payload', args.payload, '--slots', str(args.slots)]
+    portal = subprocess.Popen(portal_cmd, stdout=subprocess.DEVNULL)
+    wait_ready(portal_port)
+    env = {**os.environ, "SCU_BASE_URL": f"http://127.0.0.1:{portal_port}/portal", "PORT": str(app_port), **MODE_ENV.get(mode, {})}
+    server = subprocess.Popen([part.format(port=app_port) for part in MODES[mode]], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    wait_ready(app_port)
+    return f"http://127.0.0.1:{app_port}", [portal, server]
+
+
+def stop(procs):
+    portal, server = procs
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait(timeout=10)
+    portal.terminate()
+    portal.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', help='已在執行的服務網址，例如 http://127.0.0.1:8000')
+    parser.add_argument('--spawn', choices=sorted(MODES), help='自行啟動假上游與此模式的服務')
+    parser.add_argument('--concurrency', type=int, default=50, help='同時進行的虛擬使用者數')
+    parser.add_argument('--duration', type=float, default=30, help='最長執行秒數')
+    parser.add_argument('--flows', type=int, default=0, help='總流程數上限 (0 表示只看時間)')
+    parser.add_argument('--output', help='把結果寫成 JSON')
+    fake_portal.add_arguments(parser)
+    args = parser.parse_args()
+    if not args.target and not args.spawn:
+        parser.error('需要 --target 或 --spawn')
+
+    procs = None
+    base = args.target
+    if args.spawn:
+        base, procs = spawn(args.spawn, args)
+    try:
+        report = asyncio.run(run_load(base.rstrip('/'), args.concurrency, args.duration, args.flows))
+    finally:
+        if procs:
+            stop(procs)
+    report["config"] = {k: v for k, v in vars(args).items() if k != 'output'}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""課表處理流程各階段的微基準測試
+
+對 bench/fixtures.py 的合成課表 (dense / sparse / dense_alternating) 量測：
+    cours_table_td_data  清理全部 98 格的課程文字
+    process_course_data  建立格線與合併跨節課程
+    render_grid_html     api_course 回傳的格線 HTML
+    schedule_json        format=json 的結構化課表
+    normalize_slot       正規化全部節次代號 (含全形)
+    ics_rrule            /api/export/ics 預設的 RRULE 匯出
+    ics_expanded         /api/export/ics?expand=1 的逐週展開匯出
+    svg / pdf            /api/export/svg、/api/export/pdf 的向量匯出 (含版面計算)
+    occupancy            課表轉為 7×14 佔用位元集合
+    free_time_300        300 位成員的共同空堂排序 (/api/group/free-time 的計算部分)
+
+每個階段回報每次呼叫的最佳時間與 tracemalloc 量到的記憶體峰值，結果寫成 JSON 方便比較。
+
+用法：
+    python bench/pipeline.py --output before.json
+    python bench/pipeline.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+import vector_export  # noqa: E402
+from schedule_cache import ScheduleEntry  # noqa: E402
+from fixtures import FIXTURES  # noqa: E402
+
+# 固定在學期第一週匯出，讓 ICS 階段每次都涵蓋完整學期
+EXPORT_DAY = date(2025, 9, 8)
+FULL_WIDTH = str.maketrans("0123456789ABCDE", "０１２３４５６７８９ＡＢＣＤＥ")
+
+
+def stages(sub_result):
+    grid = app.process_course_data(sub_result)
+    entry = ScheduleEntry('bench', 114, 1, sub_result, grid, 0, 0)
+    raw_texts = [row.get(key, '') for row in sub_result for key in app.DAY_KEYS]
+    slot_labels = [row['slot'] for row in sub_result]
+    slot_labels += [label.lower() for label in slot_labels] + [label.translate(FULL_WIDTH) for label in slot_labels]
+    course_data = {'sub_result': sub_result, 'year': 114, 'semester': 1}
+    group = [app.schedule_occupancy(sub_result, grid)] * 300
+    return {
+        'cours_table_td_data': lambda: [app.cours_table_td_data(text) for text in raw_texts],
+        'process_course_data': lambda: app.process_course_data(sub_result),
+        'render_grid_html': lambda: app.render_grid_html(entry),
+        'schedule_json': lambda: app.schedule_json(entry),
+        'normalize_slot': lambda: [app.normalize_slot(label) for label in slot_labels],
+        'ics_rrule': lambda: app.build_ics(sub_result, today=EXPORT_DAY),
+        'ics_expanded': lambda: app.build_ics(sub_result, expand=True, today=EXPORT_DAY),
+        'svg': lambda: vector_export.render_svg(app.timetable_layout(course_data)),
+        'pdf': lambda: vector_export.render_pdf(app.timetable_layout(course_data)),
+        'occupancy': lambda: app.schedule_occupancy(sub_result, grid),
+        'free_time_300': lambda: app.free_slots(group, 150),
+    }
+
+
+def measure(func, repeat, min_time):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    output_bytes = len(result.encode('utf-8')) if isinstance(result, str) else len(result) if isinstance(result, bytes) else None
+    return {"us_per_call": round(best * 1e6, 2), "peak_kib": round(peak / 1024, 1), "calls": number,
+            **({"output_bytes": output_bytes} if output_bytes is not None else {})}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print("\n與基準比較 (時間比值 < 1 表示變快)")
+    for fixture, fixture_results in results.items():
+        for stage, current in fixture_results.items():
+            base = baseline.get('results', {}).get(fixture, {}).get(stage)
+            if not base:
+                continue
+            ratio = current['us_per_call'] / base['us_per_call'] if base['us_per_call'] else float('nan')
+            print(f"  {fixture:18s} {stage:20s} {base['us_per_call']:>10.1f} -> {current['us_per_call']:>10.1f} us  x{ratio:.2f}"
+                  f"   peak {base['peak_kib']:.1f} -> {current['peak_kib']:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=','.join(FIXTURES))
+    parser.add_argument('--stages', default=None, help='以逗號分隔，預設全部')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='每輪量測至少執行的秒數')
+    parser.add_argument('--output', help='把結果寫成 JSON')
+    parser.add_argument('--compare', help='與先前輸出的 JSON 比較')
+    args = parser.parse_args()
+
+    results = {}
+    for fixture in args.fixtures.split(','):
+        sub_result = FIXTURES[fixture]()
+        results[fixture] = {}
+        for stage, func in stages(sub_result).items():
+            if args.stages and stage not in args.stages.split(','):
+                continue
+            results[fixture][stage] = measure(func, args.repeat, args.min_time)
+            r = results[fixture][stage]
+            print(f"{fixture:18s} {stage:20s} {r['us_per_call']:>10.1f} us  peak {r['peak_kib']:>8.1f} KiB", flush=True)
+
+    report = {
+        "meta": {"revision": git_revision(), "python": platform.python_version(), "platform": platform.platform(),
+                 "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'), "export_day": EXPORT_DAY.isoformat()},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""建立自架的前端靜態資源 (部署時執行一次)
+
+下載固定版本的 html2canvas 與 jsPDF，並把 Noto Sans TC (可變字重) 縮減成只含介面用到的字元，
+輸出到 assets/ 目錄；app 啟動時由 assets.py 以內容雜湊產生不可變的網址提供下載。
+最後載入一次 app，讓靜態資源與首頁的 gzip / brotli 壓縮結果寫進 assets/.precompressed/，
+部署後的冷啟動直接讀檔，不必在啟動時花好幾秒壓縮。
+
+介面字元取自 app.py 內所有字串常數 (HTML、課表標籤、錯誤訊息) 加上 ASCII。課程名稱等動態文字
+若不在子集中，瀏覽器會逐字改用 font-family 中的下一個字型；可用 --extra-text 指定額外要收錄字元的文字檔。
+
+用法：
+    python build_assets.py
+    python build_assets.py --font ~/fonts/NotoSansTC[wght].ttf --extra-text common_chars.txt
+
+需要 fonttools 與 brotli (輸出 woff2)。
+"""
+import argparse
+import ast
+import io
+import os
+import shutil
+
+import requests
+
+from assets import CACHE_DIRNAME, FONT_OUTPUT, SCRIPTS
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(ROOT, 'assets')
+FONT_URL = 'https://github.com/google/fonts/raw/main/ofl/notosanstc/NotoSansTC%5Bwght%5D.ttf'
+
+
+def ui_characters(source_path=os.path.join(ROOT, 'app.py')):
+    """app.py 所有字串常數 (含 f-string 的固定部分) 用到的字元，不執行 app.py"""
+    with open(source_path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    chars = {chr(c) for c in range(0x20, 0x7f)}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            chars.update(node.value)
+    return {ch for ch in chars if ch.isprintable()}
+
+
+def fetch(source):
+    if os.path.exists(source):
+        with open(source, 'rb') as f:
+            return f.read()
+    response = requests.get(source, timeout=120)
+    response.raise_for_status()
+    return response.content
+
+
+def subset_font(font_bytes, chars):
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    font = TTFont(io.BytesIO(font_bytes))
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text=''.join(sorted(chars)))
+    subsetter.subset(font)
+    out = io.BytesIO()
+    font.flavor = 'woff2'
+    font.save(out)
+    return out.getvalue()
+
+
+def write(output_dir, name, data):
+    path = os.path.join(output_dir, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    print(f"{name:28s} {len(data) / 1024:>8.1f} KiB")
+
+
+def warm_precompressed(output_dir):
+    """載入 app：AssetBundle 與首頁在載入時壓縮並寫入快取；先清掉舊版本內容的壓縮檔"""
+    cache_dir = os.path.join(output_dir, CACHE_DIRNAME)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.environ['ASSETS_DIR'] = output_dir
+    import app  # noqa: F401
+    names = sorted(os.listdir(cache_dir)) if os.path.isdir(cache_dir) else []
+    size = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in names)
+    print(f"precompressed: {len(names)} files, {size / 1024:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=os.environ.get('ASSETS_DIR', DEFAULT_OUTPUT))
+    parser.add_argument('--font', default=FONT_URL, help='Noto Sans TC 字型的網址或本機路徑')
+    parser.add_argument('--extra-text', action='append', default=[], help='額外收錄其中字元的 UTF-8 文字檔')
+    parser.add_argument('--skip-font', action='store_true', help='只下載 JS，不產生字型子集')
+    parser.add_argument('--skip-precompress', action='store_true', help='不預先產生壓縮快取 (改由第一次啟動產生)')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    os.makedirs(output, exist_ok=True)
+    for name, url in SCRIPTS.items():
+        write(output, name, fetch(url))
+    if not args.skip_font:
+        chars = ui_characters()
+        for path in args.extra_text:
+            with open(path, encoding='utf-8') as f:
+                chars.update(ch for ch in f.read() if ch.isprintable())
+        print(f"font subset: {len(chars)} characters")
+        write(output, FONT_OUTPUT, subset_font(fetch(args.font), chars))
+    if not args.skip_precompress:
+        warm_precompressed(output)
+
+
+if __name__ == '__main__':
+    main()
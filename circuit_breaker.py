@@ -0,0 +1,98 @@
+"""上游相依服務的斷路器
+
+最近 window 次呼叫中，失敗 (例外) 或過慢 (超過 slow_call_seconds) 的比例達到 failure_rate 時跳脫 (open)，
+open_seconds 內的呼叫直接失敗；之後進入 half-open，只放行 half_open_probes 個試探請求，
+全部成功就恢復 (closed)，任何一個失敗就再次跳脫。
+"""
+import threading
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_rate=0.5, slow_call_seconds=8.0, window=20, min_calls=10,
+                 open_seconds=30.0, half_open_probes=2, clock=time.monotonic):
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._clock = clock
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.trips = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes_in_flight = self._probe_successes = 0
+        return self._state
+
+    def _trip(self):
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+        self.trips += 1
+
+    def allow(self):
+        """是否放行這次呼叫；放行後必須呼叫 record() 或 cancel()"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+            return False
+
+    def cancel(self):
+        """放行後沒有真的呼叫上游 (例如排不到連線)，歸還 half-open 的試探名額"""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes_in_flight:
+                self._probes_in_flight -= 1
+
+    def record(self, ok, duration):
+        failed = not ok or duration > self.slow_call_seconds
+        with self._lock:
+            state = self._current_state()
+            if state == self.HALF_OPEN:
+                self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+                if failed:
+                    self._trip()
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    self._state = self.CLOSED
+                    self._outcomes.clear()
+                return
+            if state == self.OPEN:
+                # 跳脫前就已放行的呼叫，結果不影響狀態
+                return
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls and sum(self._outcomes) / len(self._outcomes) >= self.failure_rate:
+                self._trip()
+
+    def retry_after(self):
+        """距離可以再試的秒數 (至少 1)"""
+        with self._lock:
+            if self._current_state() != self.OPEN:
+                return 1
+            return max(int(self.open_seconds - (self._clock() - self._opened_at)) + 1, 1)
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state()
+            outcomes = list(self._outcomes)
+        return {"state": state, "trips": self.trips, "window_calls": len(outcomes),
+                "window_failure_rate": round(sum(outcomes) / len(outcomes), 3) if outcomes else 0.0}
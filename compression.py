@@ -0,0 +1,291 @@
+"""動態回應的 gzip / brotli 壓縮 (WSGI 與 ASGI 中介層)
+
+依 Accept-Encoding 協商 (同分時 br 優先)，只壓縮 HTML、JSON、ICS、SVG 等文字內容；
+已經帶 Content-Encoding 的回應 (首頁與 /assets/ 已預先壓縮) 與 304 等沒有內容的回應原樣送出。
+沒有 Content-Length 的串流回應 (ICS 匯出) 先累積到門檻大小再決定要不要壓縮，之後邊產生邊壓縮，
+第一段與之後每累積 COMPRESSION_FLUSH_BYTES 就 flush (gzip Z_SYNC_FLUSH / brotli flush) 送出，
+瀏覽器不必等整份內容產生完就能收到前面的部分。壓縮後的位元組與原本不同，強 ETag 改為弱 ETag。
+每個回應記錄壓縮前後的大小、壓縮比與壓縮耗用的 CPU 時間 (scu_http_compression_*)。
+
+設定皆由環境變數讀取：
+    COMPRESSION_ENABLED         設為 0 關閉 (例如前面的反向代理已經會壓縮)
+    COMPRESSION_MIN_SIZE        小於此位元組數的回應不壓縮 (預設 1024)
+    COMPRESSION_GZIP_LEVEL      gzip 壓縮等級 1-9 (預設 6)
+    COMPRESSION_BROTLI_QUALITY  brotli 品質 0-11 (預設 5；動態內容每次都要重新壓縮，不用預先壓縮時的 11)
+    COMPRESSION_FLUSH_BYTES     串流回應每累積多少位元組的原始內容 flush 一次 (預設 4096；0 為每段都 flush，
+                                逐個 VEVENT flush 時壓縮後大小幾乎加倍)
+"""
+import os
+import time
+import zlib
+
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli 為選用套件，沒有安裝時只提供 gzip
+    brotli = None
+
+COMPRESSIBLE_TYPES = frozenset({'text/html', 'text/plain', 'text/css', 'text/javascript', 'application/javascript',
+                                'application/json', 'text/calendar', 'image/svg+xml'})
+NO_BODY_STATUS = frozenset({204, 206, 304})
+
+
+class Encoder:
+    """單一回應的增量壓縮器，累計輸入/輸出大小與 CPU 時間
+
+    flush_bytes 為 None 時只在 finish() 輸出剩下的內容 (內容已經齊全的回應)；串流回應傳入門檻，
+    第一段與之後每累積 flush_bytes 的輸入就 flush，壓縮器不會把內容一直留到最後。
+    """
+
+    def __init__(self, encoding, gzip_level, brotli_quality, flush_bytes=None):
+        self.encoding = encoding
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=brotli_quality)
+            self._process, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            # wbits 31：輸出含 gzip 標頭與檢查碼
+            compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self._process, self._finish = compressor.compress, compressor.flush
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.flush_bytes = flush_bytes
+        self._pending = flush_bytes
+        self.size_in = self.size_out = 0
+        self.cpu = 0.0
+
+    def _run(self, func, *args):
+        start = time.thread_time()
+        data = func(*args)
+        self.cpu += time.thread_time() - start
+        self.size_out += len(data)
+        return data
+
+    def compress(self, data):
+        self.size_in += len(data)
+        out = self._run(self._process, data)
+        if self.flush_bytes is not None:
+            self._pending += len(data)
+            if self._pending >= self.flush_bytes:
+                self._pending = 0
+                out += self._run(self._flush)
+        return out
+
+    def finish(self):
+        return self._run(self._finish)
+
+    def record(self, route):
+        metrics.COMPRESSION_BYTES.inc(route, self.encoding, 'in', amount=self.size_in)
+        metrics.COMPRESSION_BYTES.inc(route, self.encoding, 'out', amount=self.size_out)
+        metrics.COMPRESSION_CPU.observe(route, self.encoding, value=self.cpu)
+        if self.size_in:
+            metrics.COMPRESSION_RATIO.observe(route, self.encoding, value=self.size_out / self.size_in)
+
+
+def _header(headers, name):
+    name = name.lower()
+    return next((value for key, value in headers if key.lower() == name), None)
+
+
+def compressible(status, headers):
+    """依狀態碼與回應標頭判斷；Content-Length 是否達到門檻另外處理"""
+    content_type = (_header(headers, 'Content-Type') or '').split(';', 1)[0].strip().lower()
+    cache_control = (_header(headers, 'Cache-Control') or '').lower()
+    return (200 <= status and status not in NO_BODY_STATUS and content_type in COMPRESSIBLE_TYPES
+            and _header(headers, 'Content-Encoding') is None and 'no-transform' not in cache_control)
+
+
+def encoded_headers(headers, encoding):
+    """壓縮後的標頭：移除 Content-Length、加上 Content-Encoding 與 Vary，強 ETag 改為弱 ETag"""
+    result, vary = [], None
+    for key, value in headers:
+        lower = key.lower()
+        if lower == 'content-length':
+            continue
+        if lower == 'vary':
+            vary = value
+            continue
+        if lower == 'etag' and not value.startswith('W/'):
+            value = 'W/' + value
+        result.append((key, value))
+    if vary is None:
+        vary = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+        vary += ', Accept-Encoding'
+    result += [('Content-Encoding', encoding), ('Vary', vary)]
+    return result
+
+
+class _Settings:
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=5, flush_bytes=4096):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.flush_bytes = flush_bytes
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    @staticmethod
+    def env_options():
+        return {"min_size": int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)),
+                "gzip_level": int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6)),
+                "brotli_quality": int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5)),
+                "flush_bytes": int(os.environ.get('COMPRESSION_FLUSH_BYTES', 4096))}
+
+    def negotiate(self, accept_encoding):
+        if not accept_encoding:
+            return None
+        return parse_accept_header(accept_encoding, Accept).best_match(self.encodings)
+
+    def encoder(self, encoding, streamed=False):
+        # 有 Content-Length 的回應內容已經齊全，只有串流回應需要中途 flush
+        return Encoder(encoding, self.gzip_level, self.brotli_quality, self.flush_bytes if streamed else None)
+
+
+def enabled_from_env():
+    return os.environ.get('COMPRESSION_ENABLED', '1') != '0'
+
+
+class CompressionMiddleware(_Settings):
+    """WSGI 中介層；路由名稱取自 app.py 記錄指標時放進 environ 的 scu.metrics_route"""
+
+    def __init__(self, app, **options):
+        super().__init__(**options)
+        self.app = app
+
+    @classmethod
+    def wrap_from_env(cls, app):
+        return cls(app, **cls.env_options()) if enabled_from_env() else app
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            # 這個 app 不使用 write()，只保留介面
+            return lambda data: None
+
+        return self._iterate(self.app(environ, capture), environ, start_response, captured, encoding)
+
+    def _iterate(self, result, environ, start_response, captured, encoding):
+        iterator = iter(result)
+        try:
+            # start_response 最晚可以在第一段內容產生時才呼叫
+            buffered = []
+            while not captured:
+                chunk = next(iterator, None)
+                if chunk is None:
+                    break
+                buffered.append(chunk)
+            status, headers, exc_info = captured
+            length = _header(headers, 'Content-Length')
+            if not compressible(int(status.split(' ', 1)[0]), headers) or (length is not None and int(length) < self.min_size):
+                start_response(status, headers, exc_info)
+                yield from buffered
+                yield from iterator
+                return
+            # 串流回應先累積到門檻大小，整份內容都不到門檻就不壓縮
+            size = sum(map(len, buffered))
+            exhausted = False
+            while size < self.min_size:
+                chunk = next(iterator, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                buffered.append(chunk)
+                size += len(chunk)
+            if exhausted and size < self.min_size:
+                start_response(status, headers, exc_info)
+                yield from buffered
+                return
+            encoder = self.encoder(encoding, streamed=length is None)
+            start_response(status, encoded_headers(headers, encoding), exc_info)
+            data = encoder.compress(b''.join(buffered))
+            if data:
+                yield data
+            for chunk in iterator:
+                data = encoder.compress(chunk)
+                if data:
+                    yield data
+            yield encoder.finish()
+            encoder.record(environ.get('scu.metrics_route', 'unmatched'))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class CompressionASGIMiddleware(_Settings):
+    """ASGI 中介層，給 asgi.py 原生的非同步路由使用；掛在底下的 Flask app 已由 WSGI 中介層壓縮過"""
+
+    def __init__(self, app, **options):
+        super().__init__(**options)
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope.get('method') == 'HEAD':
+            return await self.app(scope, receive, send)
+        accept = next((value.decode('latin-1') for key, value in scope.get('headers', ()) if key == b'accept-encoding'), None)
+        encoding = self.negotiate(accept)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        await self.app(scope, receive, _ASGIResponder(self, scope, send, encoding).send)
+
+
+class _ASGIResponder:
+    def __init__(self, settings, scope, send, encoding):
+        self.settings = settings
+        self.scope = scope
+        self._send = send
+        self.encoding = encoding
+        self.start = None
+        self.buffered = []
+        self.size = 0
+        self.encoder = None
+        self.passthrough = False
+        self.streamed = False
+
+    def _route(self):
+        route = self.scope.get('route')
+        return getattr(route, 'path', None) or self.scope.get('path', 'unmatched')
+
+    async def send(self, message):
+        if self.passthrough:
+            return await self._send(message)
+        if message['type'] == 'http.response.start':
+            headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in message.get('headers', ())]
+            length = _header(headers, 'Content-Length')
+            if not compressible(message['status'], headers) or (length is not None and int(length) < self.settings.min_size):
+                self.passthrough = True
+                return await self._send(message)
+            self.start = message
+            self.streamed = length is None
+            return
+        if message['type'] != 'http.response.body':
+            return await self._send(message)
+        body, more = message.get('body', b''), message.get('more_body', False)
+        if self.encoder is None:
+            self.buffered.append(body)
+            self.size += len(body)
+            if self.size < self.settings.min_size:
+                if more:
+                    return
+                # 整份內容都不到門檻，原樣送出
+                self.passthrough = True
+                await self._send(self.start)
+                return await self._send({"type": "http.response.body", "body": b''.join(self.buffered), "more_body": False})
+            self.encoder = self.settings.encoder(self.encoding, streamed=self.streamed)
+            headers = [(k.encode('latin-1'), v.encode('latin-1'))
+                       for k, v in encoded_headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in self.start.get('headers', ())], self.encoding)]
+            await self._send({**self.start, "headers": headers})
+            body = b''.join(self.buffered)
+            self.buffered = []
+        data = self.encoder.compress(body)
+        if not more:
+            data += self.encoder.finish()
+            self.encoder.record(self._route())
+        if data or not more:
+            await self._send({"type": "http.response.body", "body": data, "more_body": more})
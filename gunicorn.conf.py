@@ -0,0 +1,118 @@
+"""gunicorn 正式環境設定
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+preload_app 讓 master 先載入一次 app.py (含 html 字串、Jinja 樣板與所有 import)，
+fork 出來的 worker 以 copy-on-write 共用這些記憶體頁；載入後先 gc.freeze()，
+避免 worker 的垃圾回收掃過這些物件時改寫參考計數所在的頁面。
+worker 為 gthread：請求大多在等校務系統，執行緒等待時不佔 CPU。
+
+設定皆由環境變數讀取：
+    PORT                  監聽埠 (預設 5000)
+    WEB_CONCURRENCY       worker 數；未設定時依 CPU (含 cgroup 配額) 與記憶體計算
+    WEB_THREADS           每個 worker 的執行緒數 (預設為上游併發上限的 2 倍)
+    WEB_WORKER_MEMORY_MB  估計每個 worker 佔用的記憶體 (預設 96)
+    WEB_TIMEOUT           單一請求最長的秒數 (預設依 UPSTREAM_TIMEOUT 計算，可完成登入加查詢課表兩次上游呼叫)
+    WEB_MAX_REQUESTS      每個 worker 處理多少請求後重啟，回收記憶體碎片 (預設 2000，0 為不重啟)
+    METRICS_MULTIPROC_DIR 各 worker 指標快照的目錄 (預設在暫存目錄下自動建立)
+
+每個 worker 的指標各自累計，/metrics 不論打到哪個 worker 都讀取所有 worker 的快照合併輸出 (見 metrics.py)。
+
+session 或訂閱使用 memory 後端時各 worker 看不到彼此的資料，未設定 WEB_CONCURRENCY 時只開一個 worker。
+"""
+import gc
+import math
+import os
+import tempfile
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_limit():
+    """容器的 CPU 配額 (cgroup v2 cpu.max 或 v1 cfs_quota)，沒有限制時為可用的 CPU 數"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    quota = _read('/sys/fs/cgroup/cpu.max')
+    if quota:
+        limit, period = (quota.split() + ['100000'])[:2]
+        if limit != 'max':
+            return min(cpus, int(limit) / int(period))
+    limit, period = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'), _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if limit and period and int(limit) > 0:
+        return min(cpus, int(limit) / int(period))
+    return cpus
+
+
+def memory_limit_mb():
+    physical = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        value = _read(path)
+        if value and value.isdigit():
+            return min(physical, int(value) // (1024 * 1024))
+    return physical
+
+
+def default_workers():
+    if any(os.environ.get(name, 'memory') == 'memory' for name in ('SESSION_BACKEND', 'SUBSCRIPTION_BACKEND')):
+        return 1
+    by_cpu = 2 * math.ceil(cpu_limit()) + 1
+    # master 與 preload 的共用頁面先保留一個 worker 的量
+    by_memory = memory_limit_mb() // int(os.environ.get('WEB_WORKER_MEMORY_MB', 96)) - 1
+    return max(1, min(by_cpu, by_memory))
+
+
+def default_timeout():
+    # 登入與查詢課表各一次上游呼叫，各自最多 connect + read 秒，再留一點處理時間
+    parts = [float(p) for p in os.environ.get('UPSTREAM_TIMEOUT', '5,30').split(',') if p.strip()]
+    return int(2 * sum(parts if len(parts) == 2 else parts * 2) + 10)
+
+
+# 在 preload 載入 metrics.py 之前設定
+os.environ.setdefault('METRICS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f"scu-metrics-{os.getpid()}"))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+preload_app = True
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY') or default_workers())
+# 超過上游併發上限的執行緒仍可服務首頁、靜態資源與匯出，其餘的會在 UPSTREAM_ADMISSION_TIMEOUT 後快速失敗
+threads = int(os.environ.get('WEB_THREADS') or 2 * int(os.environ.get('UPSTREAM_MAX_CONCURRENCY') or os.environ.get('UPSTREAM_MAX_PER_HOST', 10)))
+timeout = int(os.environ.get('WEB_TIMEOUT') or default_timeout())
+# 重啟或回收 worker 時，讓進行中的上游請求有完整的逾時時間可以完成
+graceful_timeout = timeout
+keepalive = 5
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 2000))
+# 錯開各 worker 的重啟時間，避免同時冷啟動
+max_requests_jitter = max_requests // 10
+accesslog = '-'
+errorlog = '-'
+
+
+def when_ready(server):
+    import metrics
+    metrics.REGISTRY.reset_multiprocess_dir()
+    # preload 後、fork 前執行：之後建立的物件才會被 worker 的 GC 追蹤
+    gc.freeze()
+    server.log.info("workers=%s threads=%s timeout=%ss max_requests=%s (cpu=%s, memory=%sMB)",
+                    workers, threads, timeout, max_requests, cpu_limit(), memory_limit_mb())
+
+
+def post_worker_init(worker):
+    import metrics
+    metrics.REGISTRY.start_snapshot_writer()
+
+
+def worker_exit(server, worker):
+    # 正常結束 (含 max_requests 回收) 時寫入最後的快照
+    import metrics
+    metrics.REGISTRY.write_snapshot()
+
+
+def child_exit(server, worker):
+    # master：把結束的 worker 的累計值併入 archive，之後的 /metrics 不會倒退
+    import metrics
+    metrics.REGISTRY.mark_process_dead(worker.pid)
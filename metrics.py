@@ -0,0 +1,346 @@
+"""Prometheus 文字格式的行程內指標
+
+不依賴 prometheus_client；Counter / Gauge / Histogram 都以一把鎖保護，每次記錄只是幾個加法。
+/metrics 會輸出這裡登記的所有指標。
+
+gunicorn 的多個 worker 各有自己的指標，/metrics 只會打到其中一個。設定 METRICS_MULTIPROC_DIR
+(gunicorn.conf.py 會自動設定) 後，每個 worker 每秒把自己的快照寫成 <目錄>/<pid>.json，
+/metrics 讀取所有快照合併輸出：Counter 與 Histogram 相加，Gauge 加上 pid label 各自列出。
+worker 結束時 master 把它的 Counter 與 Histogram 併入 archive.json，累計值不會因為 worker 回收而倒退。
+"""
+import bisect
+import functools
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RATIO_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.7, 1.0)
+CPU_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(v) for v in labels)
+
+    def collect(self):
+        """{name, kind, doc, samples: [[[label, 值], ...], 值]}；Histogram 另帶 buckets，值為 [各 bucket 次數, 總和, 次數]"""
+        with self._lock:
+            items = sorted((key, self._copy(value)) for key, value in self._values.items())
+        return {"name": self.name, "kind": self.kind, "doc": self.documentation,
+                "samples": [[[list(pair) for pair in zip(self.labelnames, key)], value] for key, value in items]}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, *labels):
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 每個 bucket 只記自己的次數，輸出時再累加
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    @staticmethod
+    def _copy(state):
+        return [[*state[0]], state[1], state[2]]
+
+    def collect(self):
+        return {**super().collect(), "buckets": list(self.buckets)}
+
+
+def _render_family(family):
+    name = family["name"]
+    lines = [f"# HELP {name} {family['doc']}", f"# TYPE {name} {family['kind']}"]
+    for labels, value in family["samples"]:
+        names, values = [n for n, _ in labels], [v for _, v in labels]
+        if family["kind"] != 'histogram':
+            lines.append(f"{name}{_format_labels(names, values)} {_format_value(value)}")
+            continue
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip(family["buckets"] + [float('inf')], counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(names, values, [('le', _format_value(float(bound)))])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(names, values)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(names, values)} {count}")
+    return lines
+
+
+def _merge(snapshots):
+    """[(pid 或 None, families)] 合併成一份 families；pid 為 None 的是已結束 worker 的累計 (不含 Gauge)"""
+    merged = {}
+    for pid, families in snapshots:
+        for family in families:
+            target = merged.setdefault(family["name"], {**family, "samples": {}})["samples"]
+            for labels, value in family["samples"]:
+                key = tuple(tuple(pair) for pair in labels)
+                if family["kind"] == 'gauge':
+                    if pid is not None:
+                        target[key + (('pid', str(pid)),)] = value
+                elif family["kind"] == 'histogram':
+                    current = target.get(key)
+                    target[key] = value if current is None else \
+                        [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2]]
+                else:
+                    target[key] = target.get(key, 0) + value
+    return [{**family, "samples": [[list(map(list, key)), value] for key, value in family["samples"].items()]}
+            for family in merged.values()]
+
+
+class Registry:
+    def __init__(self, multiprocess_dir=None):
+        self._metrics = []
+        self._collectors = []
+        self.multiprocess_dir = multiprocess_dir
+        self._last_snapshot = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector):
+        """collector() 回傳 [(名稱, 型別, 說明, [(labels dict, 值), ...]), ...]，在輸出時才取值"""
+        self._collectors.append(collector)
+
+    def collect(self):
+        families = [metric.collect() for metric in self._metrics]
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                families.append({"name": name, "kind": kind, "doc": documentation,
+                                 "samples": [[[list(pair) for pair in labels.items()], value] for labels, value in samples]})
+        return families
+
+    def render(self):
+        if self.multiprocess_dir is None:
+            families = self.collect()
+        else:
+            # 先寫入自己的快照，回應這次 scrape 的 worker 不會落後
+            self.write_snapshot()
+            families = self._collect_all()
+        lines = []
+        for family in families:
+            lines.extend(_render_family(family))
+        return '\n'.join(lines) + '\n'
+
+    # --- 多行程 (gunicorn worker) 合併 ---
+    @contextmanager
+    def _dir_lock(self, exclusive):
+        import fcntl  # 只有 gunicorn (POSIX) 會用到多行程模式
+        with open(os.path.join(self.multiprocess_dir, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.multiprocess_dir, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, name, data):
+        # 先寫暫存檔再改名，讀取端不會看到寫到一半的快照
+        fd, tmp = tempfile.mkstemp(dir=self.multiprocess_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.multiprocess_dir, name))
+
+    def write_snapshot(self):
+        """把這個行程的指標寫成 <pid>.json；內容沒變時不寫"""
+        if self.multiprocess_dir is None:
+            return
+        data = json.dumps(self.collect())
+        if data != self._last_snapshot:
+            self._write(f"{os.getpid()}.json", data)
+            self._last_snapshot = data
+
+    def start_snapshot_writer(self, interval=1.0):
+        """worker 啟動後呼叫：背景執行緒定期寫入快照，閒置的 worker 最後幾個請求也會在 interval 內反映"""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot()
+        if self.multiprocess_dir is not None:
+            threading.Thread(target=run, name='metrics-snapshot', daemon=True).start()
+
+    def _collect_all(self):
+        with self._dir_lock(exclusive=False):
+            snapshots = [(None, self._read('archive.json') or [])]
+            for path in glob.glob(os.path.join(self.multiprocess_dir, '[0-9]*.json')):
+                name = os.path.basename(path)
+                families = self._read(name)
+                if families is not None:
+                    snapshots.append((name[:-len('.json')], families))
+        return _merge(snapshots)
+
+    def mark_process_dead(self, pid):
+        """master 在 worker 結束後呼叫：它的 Counter 與 Histogram 併入 archive.json，Gauge 捨棄"""
+        if self.multiprocess_dir is None:
+            return
+        with self._dir_lock(exclusive=True):
+            families = self._read(f"{pid}.json")
+            if families is None:
+                return
+            archive = _merge([(None, self._read('archive.json') or []), (None, families)])
+            self._write('archive.json', json.dumps([f for f in archive if f["kind"] != 'gauge']))
+            os.remove(os.path.join(self.multiprocess_dir, f"{pid}.json"))
+
+    def reset_multiprocess_dir(self):
+        """master 啟動時呼叫，清掉上一次執行留下的快照"""
+        if self.multiprocess_dir is None:
+            return
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(self.multiprocess_dir, '*.json')):
+            os.remove(path)
+
+
+REGISTRY = Registry(multiprocess_dir=os.environ.get('METRICS_MULTIPROC_DIR') or None)
+
+HTTP_REQUESTS = Counter('scu_http_requests_total', 'HTTP requests by route, method and status.', ('route', 'method', 'status'))
+HTTP_LATENCY = Histogram('scu_http_request_duration_seconds', 'Time spent producing the response, by route.', ('route',))
+HTTP_RESPONSE_SIZE = Histogram('scu_http_response_size_bytes', 'Response body size, by route.', ('route',), buckets=SIZE_BUCKETS)
+HTTP_IN_FLIGHT = Gauge('scu_http_requests_in_flight', 'Requests currently being handled.')
+UPSTREAM_REQUESTS = Counter('scu_upstream_requests_total', 'jsonApi.php calls by libName and outcome.', ('lib_name', 'status'))
+UPSTREAM_LATENCY = Histogram('scu_upstream_request_duration_seconds', 'jsonApi.php call latency by libName.', ('lib_name',))
+UPSTREAM_REJECTED = Counter('scu_upstream_rejected_total', 'Calls failed fast without reaching the portal, by reason.', ('lib_name', 'reason'))
+UPSTREAM_COALESCED = Counter('scu_upstream_coalesced_total', 'Calls answered by an identical in-flight jsonApi.php request.', ('lib_name',))
+STAGE_LATENCY = Histogram('scu_stage_duration_seconds', 'Time spent in internal processing stages.', ('stage',))
+COMPRESSION_RATIO = Histogram('scu_http_compression_ratio', 'Compressed size divided by original size, by route and encoding.',
+                              ('route', 'encoding'), buckets=RATIO_BUCKETS)
+COMPRESSION_CPU = Histogram('scu_http_compression_cpu_seconds', 'CPU time spent compressing a response body, by route and encoding.',
+                            ('route', 'encoding'), buckets=CPU_BUCKETS)
+COMPRESSION_BYTES = Counter('scu_http_compression_bytes_total', 'Response body bytes before (in) and after (out) compression.',
+                            ('route', 'encoding', 'direction'))
+
+
+def timed_stage(stage):
+    """把函式的執行時間記到 scu_stage_duration_seconds{stage=...}"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                STAGE_LATENCY.observe(stage, value=time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def timed_iter(stage, iterable):
+    """只累計 generator 自己產生內容的時間，不含下游消費 (例如網路傳送) 的時間"""
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                return
+            elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        STAGE_LATENCY.observe(stage, value=elapsed)
+
+
+def count_bytes(route, iterable):
+    """串流回應在傳送完後才知道大小；str 片段在這裡先編碼成 UTF-8，計算的是實際傳送的位元組"""
+    size = 0
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            size += len(chunk)
+            yield chunk
+    finally:
+        HTTP_RESPONSE_SIZE.observe(route, value=size)
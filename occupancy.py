@@ -0,0 +1,98 @@
+"""課表佔用的位元集合表示法
+
+一週 7 天 × 14 節共 98 格，每格一個位元 (bit = day * 14 + 節次序號)，整份課表就是一個 Python int，
+交集、聯集都是一次位元運算。單週與雙週各用一個位元平面 (odd / even)：
+一般課程兩個平面都佔用，(單) 只佔 odd，(雙) 只佔 even。
+"""
+
+SLOT_LABELS = ('1', '2', '3', '4', 'E', '5', '6', '7', '8', '9', 'A', 'B', 'C', 'D')
+SLOT_INDEX = {label: i for i, label in enumerate(SLOT_LABELS)}
+NUM_SLOTS = len(SLOT_LABELS)
+NUM_DAYS = 7
+NUM_BITS = NUM_SLOTS * NUM_DAYS
+ALL_BITS = (1 << NUM_BITS) - 1
+
+
+def bit(day, slot_pos):
+    return 1 << (day * NUM_SLOTS + slot_pos)
+
+
+def position(bit_index):
+    """位元序號 -> (day, 節次序號)"""
+    return divmod(bit_index, NUM_SLOTS)
+
+
+def week_parity(text):
+    """課程文字標示 (單)/(雙) 時回傳 'odd'/'even'，每週上課回傳 None (與 ICS 匯出的判斷相同)"""
+    if '單' in text:
+        return 'odd'
+    if '雙' in text:
+        return 'even'
+    return None
+
+
+def iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class Occupancy:
+    __slots__ = ('odd', 'even')
+
+    def __init__(self, odd=0, even=0):
+        self.odd = odd
+        self.even = even
+
+    def add(self, day, slot_pos, parity=None):
+        b = bit(day, slot_pos)
+        if parity != 'even':
+            self.odd |= b
+        if parity != 'odd':
+            self.even |= b
+
+    def overlap(self, other):
+        """兩份課表在單週、雙週各自重疊的格子 (odd_mask, even_mask)"""
+        return self.odd & other.odd, self.even & other.even
+
+    def to_dict(self):
+        return {"odd": f"{self.odd:x}", "even": f"{self.even:x}"}
+
+
+def _add_to_counters(counters, mask):
+    # 逐位元平行的二進位計數器 (bit-sliced)：counters[i] 的每個位元是該格計數的第 i 位
+    carry = mask
+    i = 0
+    while carry:
+        if i == len(counters):
+            counters.append(0)
+        counters[i], carry = counters[i] ^ carry, counters[i] & carry
+        i += 1
+
+
+def busy_counts(masks):
+    """回傳長度 98 的清單：每一格被幾份課表佔用；成本是 O(成員數 × log 成員數) 次整數位元運算"""
+    counters = []
+    for mask in masks:
+        _add_to_counters(counters, mask)
+    counts = [0] * NUM_BITS
+    for weight, counter in enumerate(counters):
+        for b in iter_bits(counter):
+            counts[b] += 1 << weight
+    return counts
+
+
+def free_slots(occupancies, min_free, mask=ALL_BITS):
+    """至少 min_free 人有空的格子，回傳 [(bit, 單週有空人數, 雙週有空人數)]
+
+    排序：每週都有空的人數多者優先，其次是單雙週合計，最後依星期、節次。
+    """
+    occupancies = list(occupancies)
+    total = len(occupancies)
+    busy_odd = busy_counts(o.odd & mask for o in occupancies)
+    busy_even = busy_counts(o.even & mask for o in occupancies)
+    result = [(b, total - busy_odd[b], total - busy_even[b]) for b in iter_bits(mask)
+              if total - min(busy_odd[b], busy_even[b]) >= min_free]
+    result.sort(key=lambda r: (-min(r[1], r[2]), -(r[1] + r[2]), r[0]))
+    return result
@@ -0,0 +1,79 @@
+"""啟動時預先建好的不可變回應內容 (原始 / gzip / brotli) 與強 ETag
+
+brotli 品質 11 壓縮幾百 KB 的 JS 要好幾秒，壓縮結果以內容雜湊為檔名存進 cache_dir，
+之後啟動直接讀檔；build_assets.py 在部署建置時就先寫好，冷啟動不必再壓縮。
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # brotli 為選用套件，沒有安裝時只提供 gzip
+    brotli = None
+
+
+def cached_compress(cache_dir, name, compress):
+    """cache_dir 有同名檔案就直接讀取，否則壓縮後寫入；目錄無法寫入 (唯讀檔案系統) 時只是不快取"""
+    if cache_dir is None:
+        return compress()
+    path = os.path.join(cache_dir, name)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+    data = compress()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # 多個行程可能同時寫入，先寫暫存檔再改名，讀取端不會看到寫到一半的檔案
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp 建立的檔案只有擁有者可讀，建置與執行的使用者可能不同
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return data
+
+
+class PrecompressedBody:
+    """一份固定內容的所有編碼版本，依 Accept-Encoding 挑選並處理 If-None-Match"""
+
+    def __init__(self, body, mimetype, max_age=86400, immutable=False, cache_dir=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.cache_control = f"public, max-age={max_age}" + (", immutable" if immutable else "")
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.digest = digest
+        # 每種編碼是不同的表示法，強 ETag 必須各自不同
+        self.variants = {'identity': (body, f'"{digest}"')}
+        compressed = cached_compress(cache_dir, f"{digest}.gz", lambda: gzip.compress(body, compresslevel=9, mtime=0))
+        self.variants['gzip'] = (compressed, f'"{digest}-gz"')
+        if brotli is not None:
+            compressed = cached_compress(cache_dir, f"{digest}.br", lambda: brotli.compress(body, quality=11))
+            self.variants['br'] = (compressed, f'"{digest}-br"')
+        # woff2 等本身已壓縮的內容，壓縮後不會更小，只保留原始版本
+        for encoding in ('gzip', 'br'):
+            if encoding in self.variants and len(self.variants[encoding][0]) >= len(body):
+                del self.variants[encoding]
+        self.etags = {etag for _, etag in self.variants.values()}
+
+    def choose_encoding(self, request):
+        offered = [enc for enc in ('br', 'gzip') if enc in self.variants]
+        return request.accept_encodings.best_match(offered) or 'identity'
+
+    def response(self, request):
+        encoding = self.choose_encoding(request)
+        body, etag = self.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if encoding != 'identity':
+            headers["Content-Encoding"] = encoding
+        if any(request.if_none_match.contains_weak(e.strip('"')) for e in self.etags):
+            return Response(status=304, headers=headers)
+        return Response(body, mimetype=self.mimetype, headers=headers)
@@ -0,0 +1,373 @@
+"""課表快取，以 (userId, 學年, 學期) 為鍵
+
+存放解析後的 SubRESULT 與 process_course_data 的結果，重複查詢時可以完全跳過上游與格線計算。
+另外以內容雜湊為名稱存放預先產生好的格線 HTML 與 ICS (artifact)，與課表共用大小上限，超過時先淘汰 artifact。
+
+memory 後端只在單一行程內有效；sqlite 後端 (WAL) 讓同一台主機上的所有 gunicorn worker 共用，
+命中率不會因為 worker 數變多而下降。sqlite 中的 SubRESULT 以 JSON 保存，
+每個 worker 讀出後在本地保留解碼好的 entry，同一版本只需重建一次格線。
+
+設定皆由環境變數讀取：
+    SCHEDULE_CACHE_BACKEND      memory (預設) 或 sqlite
+    SCHEDULE_CACHE_SQLITE_PATH  sqlite 檔案路徑 (預設 schedule_cache.sqlite3)
+    SCHEDULE_CACHE_TTL          資料視為新鮮的秒數 (預設 21600)
+    SCHEDULE_CACHE_STALE        過期後仍可先回傳舊資料、同時背景更新的秒數 (預設 86400)
+    SCHEDULE_CACHE_MAX_ENTRIES  最多保存的課表數 (預設 1000)
+    SCHEDULE_CACHE_MAX_BYTES    保存內容的估計位元組上限 (預設 64 MB)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlite_conn import ThreadLocalConnection
+
+
+class ScheduleEntry:
+    __slots__ = ('user_id', 'year', 'semester', 'sub_result', 'grid', 'size', 'stored_at', 'digest')
+
+    def __init__(self, user_id, year, semester, sub_result, grid, size, stored_at, digest=None):
+        self.user_id = user_id
+        self.year = year
+        self.semester = semester
+        self.sub_result = sub_result
+        self.grid = grid
+        self.size = size
+        self.stored_at = stored_at
+        # SubRESULT 內容的雜湊，作為 artifact 名稱的一部分
+        self.digest = digest
+
+    @property
+    def key(self):
+        return (self.user_id, self.year, self.semester)
+
+
+def serialize(sub_result):
+    """回傳 (JSON 位元組, 內容雜湊)"""
+    body = json.dumps(sub_result, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return body, hashlib.sha1(body).hexdigest()[:20]
+
+
+class ScheduleCache:
+    FRESH, STALE = 'fresh', 'stale'
+
+    def __init__(self, ttl=21600, stale_ttl=86400, max_entries=1000, max_bytes=64 * 1024 * 1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._artifacts = OrderedDict()
+        self._latest_term = {}
+        self._refreshing = set()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.stale_hits = self.misses = self.evictions = 0
+        self.artifact_hits = self.artifact_misses = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=int(os.environ.get('SCHEDULE_CACHE_TTL', 21600)),
+            stale_ttl=int(os.environ.get('SCHEDULE_CACHE_STALE', 86400)),
+            max_entries=int(os.environ.get('SCHEDULE_CACHE_MAX_ENTRIES', 1000)),
+            max_bytes=int(os.environ.get('SCHEDULE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+        )
+
+    def lookup(self, user_id, year=None, semester=None):
+        """回傳 (entry, 狀態)；沒指定學期時使用該使用者最近一次查到的學期"""
+        with self._lock:
+            if year is None or semester is None:
+                term = self._latest_term.get(user_id)
+                if term is None:
+                    self.misses += 1
+                    return None, None
+                year, semester = term
+            key = (user_id, int(year), int(semester))
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            age = self._clock() - entry.stored_at
+            if age > self.ttl + self.stale_ttl:
+                self._remove(key)
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(key)
+            if age > self.ttl:
+                self.stale_hits += 1
+                return entry, self.STALE
+            self.hits += 1
+            return entry, self.FRESH
+
+    def put(self, user_id, year, semester, sub_result, grid):
+        # 以 JSON 長度估計大小，格線結果約與原始資料同量級
+        body, digest = serialize(sub_result)
+        entry = ScheduleEntry(user_id, year, semester, sub_result, grid, 2 * len(body), self._clock(), digest)
+        with self._lock:
+            if entry.key in self._entries:
+                self._remove(entry.key)
+            self._entries[entry.key] = entry
+            self._bytes += entry.size
+            self._latest_term[user_id] = (year, semester)
+            self._refreshing.discard(entry.key)
+            self._evict()
+        return entry
+
+    def get_artifact(self, name):
+        with self._lock:
+            body = self._artifacts.get(name)
+            if body is None:
+                self.artifact_misses += 1
+                return None
+            self._artifacts.move_to_end(name)
+            self.artifact_hits += 1
+            return body
+
+    def put_artifact(self, name, body):
+        with self._lock:
+            old = self._artifacts.pop(name, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._artifacts[name] = body
+            self._bytes += len(body)
+            self._evict()
+
+    def _evict(self):
+        # artifact 可以由課表重新產生，先淘汰
+        while self._artifacts and self._bytes > self.max_bytes:
+            self._bytes -= len(self._artifacts.popitem(last=False)[1])
+            self.evictions += 1
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def begin_refresh(self, key):
+        """同一個鍵同時只允許一個背景更新，回傳是否取得更新權"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        if self._latest_term.get(entry.user_id) == (entry.year, entry.semester):
+            del self._latest_term[entry.user_id]
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._entries), "artifacts": len(self._artifacts), "bytes": self._bytes,
+                    "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses, "evictions": self.evictions,
+                    "artifact_hits": self.artifact_hits, "artifact_misses": self.artifact_misses}
+
+
+class SQLiteScheduleCache:
+    """存在 sqlite (WAL) 檔案中的課表快取，同一台主機上的多個 worker 共用；介面與 ScheduleCache 相同"""
+    FRESH, STALE = ScheduleCache.FRESH, ScheduleCache.STALE
+    # 背景更新的標記超過這個秒數視為該 worker 已經不在，允許其他 worker 接手
+    REFRESH_LEASE = 120
+    # 命中時最多每隔幾秒更新一次 used_at，避免每次讀取都變成寫入
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, build_grid, ttl=21600, stale_ttl=86400, max_entries=1000, max_bytes=64 * 1024 * 1024,
+                 clock=time.time, local_entries=256):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._build_grid = build_grid
+        self._clock = clock
+        self._connect = ThreadLocalConnection(path)
+        # 本 worker 已解碼的 entry，以 (鍵, stored_at) 辨識版本
+        self._decoded = OrderedDict()
+        self._local_entries = local_entries
+        self._lock = threading.Lock()
+        self.hits = self.stale_hits = self.misses = self.evictions = 0
+        self.artifact_hits = self.artifact_misses = 0
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS schedules (user_id TEXT NOT NULL, year INTEGER NOT NULL, semester INTEGER NOT NULL, "
+                         "sub_result BLOB NOT NULL, digest TEXT NOT NULL, size INTEGER NOT NULL, stored_at REAL NOT NULL, "
+                         "used_at REAL NOT NULL, PRIMARY KEY (user_id, year, semester))")
+            conn.execute("CREATE INDEX IF NOT EXISTS schedules_used_at ON schedules (used_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS artifacts (name TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_used_at ON artifacts (used_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS refreshing (user_id TEXT NOT NULL, year INTEGER NOT NULL, semester INTEGER NOT NULL, "
+                         "started_at REAL NOT NULL, PRIMARY KEY (user_id, year, semester))")
+
+    @classmethod
+    def from_env(cls, build_grid):
+        return cls(
+            os.environ.get('SCHEDULE_CACHE_SQLITE_PATH', 'schedule_cache.sqlite3'),
+            build_grid,
+            ttl=int(os.environ.get('SCHEDULE_CACHE_TTL', 21600)),
+            stale_ttl=int(os.environ.get('SCHEDULE_CACHE_STALE', 86400)),
+            max_entries=int(os.environ.get('SCHEDULE_CACHE_MAX_ENTRIES', 1000)),
+            max_bytes=int(os.environ.get('SCHEDULE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+        )
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _decode(self, key, stored_at, size, conn):
+        with self._lock:
+            cached = self._decoded.get(key)
+            if cached is not None and cached.stored_at == stored_at:
+                self._decoded.move_to_end(key)
+                return cached
+        row = conn.execute("SELECT sub_result, digest FROM schedules WHERE user_id = ? AND year = ? AND semester = ? AND stored_at = ?",
+                           (*key, stored_at)).fetchone()
+        if row is None:
+            return None
+        sub_result = json.loads(bytes(row[0]))
+        entry = ScheduleEntry(*key, sub_result, self._build_grid(sub_result), size, stored_at, row[1])
+        self._remember(entry)
+        return entry
+
+    def _remember(self, entry):
+        with self._lock:
+            self._decoded[entry.key] = entry
+            self._decoded.move_to_end(entry.key)
+            while len(self._decoded) > self._local_entries:
+                self._decoded.popitem(last=False)
+
+    def lookup(self, user_id, year=None, semester=None):
+        """回傳 (entry, 狀態)；沒指定學期時使用該使用者最近一次查到的學期"""
+        conn = self._connect()
+        if year is None or semester is None:
+            row = conn.execute("SELECT year, semester, stored_at, used_at, size FROM schedules WHERE user_id = ? "
+                               "ORDER BY stored_at DESC LIMIT 1", (user_id,)).fetchone()
+        else:
+            row = conn.execute("SELECT year, semester, stored_at, used_at, size FROM schedules WHERE user_id = ? AND year = ? AND semester = ?",
+                               (user_id, int(year), int(semester))).fetchone()
+        if row is None:
+            self._count('misses')
+            return None, None
+        key, (stored_at, used_at, size) = (user_id, row[0], row[1]), row[2:]
+        now = self._clock()
+        age = now - stored_at
+        if age > self.ttl + self.stale_ttl:
+            with conn:
+                conn.execute("DELETE FROM schedules WHERE user_id = ? AND year = ? AND semester = ? AND stored_at = ?", (*key, stored_at))
+            self._count('misses')
+            return None, None
+        entry = self._decode(key, stored_at, size, conn)
+        if entry is None:
+            # 讀取兩步之間被其他 worker 覆寫或淘汰
+            self._count('misses')
+            return None, None
+        if now - used_at > self.TOUCH_INTERVAL:
+            with conn:
+                conn.execute("UPDATE schedules SET used_at = ? WHERE user_id = ? AND year = ? AND semester = ?", (now, *key))
+        if age > self.ttl:
+            self._count('stale_hits')
+            return entry, self.STALE
+        self._count('hits')
+        return entry, self.FRESH
+
+    def put(self, user_id, year, semester, sub_result, grid):
+        body, digest = serialize(sub_result)
+        now = self._clock()
+        entry = ScheduleEntry(user_id, year, semester, sub_result, grid, 2 * len(body), now, digest)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO schedules VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (user_id, year, semester, body, digest, entry.size, now, now))
+            conn.execute("DELETE FROM refreshing WHERE user_id = ? AND year = ? AND semester = ?", entry.key)
+            self._evict(conn)
+        self._remember(entry)
+        return entry
+
+    def begin_refresh(self, key):
+        """同一個鍵同時只允許一個背景更新 (跨 worker)，回傳是否取得更新權"""
+        now = self._clock()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM refreshing WHERE user_id = ? AND year = ? AND semester = ? AND started_at < ?",
+                         (*key, now - self.REFRESH_LEASE))
+            return conn.execute("INSERT OR IGNORE INTO refreshing VALUES (?, ?, ?, ?)", (*key, now)).rowcount > 0
+
+    def end_refresh(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM refreshing WHERE user_id = ? AND year = ? AND semester = ?", key)
+
+    def invalidate(self, user_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM schedules WHERE user_id = ?", (user_id,))
+        with self._lock:
+            for key in [k for k in self._decoded if k[0] == user_id]:
+                del self._decoded[key]
+
+    def get_artifact(self, name):
+        conn = self._connect()
+        row = conn.execute("SELECT body, used_at FROM artifacts WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            self._count('artifact_misses')
+            return None
+        now = self._clock()
+        if now - row[1] > self.TOUCH_INTERVAL:
+            with conn:
+                conn.execute("UPDATE artifacts SET used_at = ? WHERE name = ?", (now, name))
+        self._count('artifact_hits')
+        return bytes(row[0])
+
+    def put_artifact(self, name, body):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?)", (name, body, len(body), self._clock()))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        # 與 ScheduleCache 相同：先淘汰最久沒用到的 artifact，再淘汰課表
+        entries, entry_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM schedules").fetchone()
+        artifact_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        excess = entry_bytes + artifact_bytes - self.max_bytes
+        evicted = 0
+        if excess > 0:
+            for name, size in conn.execute("SELECT name, size FROM artifacts ORDER BY used_at").fetchall():
+                if excess <= 0:
+                    break
+                conn.execute("DELETE FROM artifacts WHERE name = ?", (name,))
+                excess -= size
+                evicted += 1
+        if excess > 0 or entries > self.max_entries:
+            for user_id, year, semester, size in conn.execute("SELECT user_id, year, semester, size FROM schedules ORDER BY used_at").fetchall():
+                if excess <= 0 and entries <= self.max_entries:
+                    break
+                conn.execute("DELETE FROM schedules WHERE user_id = ? AND year = ? AND semester = ?", (user_id, year, semester))
+                excess -= size
+                entries -= 1
+                evicted += 1
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def stats(self):
+        conn = self._connect()
+        entries, entry_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM schedules").fetchone()
+        artifacts, artifact_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM artifacts").fetchone()
+        # 命中次數是本 worker 的統計，數量與大小是所有 worker 共用的
+        with self._lock:
+            return {"backend": "sqlite", "entries": entries, "artifacts": artifacts, "bytes": entry_bytes + artifact_bytes,
+                    "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses, "evictions": self.evictions,
+                    "artifact_hits": self.artifact_hits, "artifact_misses": self.artifact_misses,
+                    "local_entries": len(self._decoded)}
+
+
+def schedule_cache_from_env(build_grid):
+    """build_grid 為 SubRESULT -> 格線的函式 (process_course_data)，sqlite 後端讀出 SubRESULT 後用它重建格線"""
+    if os.environ.get('SCHEDULE_CACHE_BACKEND', 'memory') == 'sqlite':
+        return SQLiteScheduleCache.from_env(build_grid)
+    return ScheduleCache.from_env()
@@ -0,0 +1,162 @@
+"""伺服器端 session：cookie 只帶不透明的 session id，內容存在伺服器上
+
+設定皆由環境變數讀取：
+    SESSION_BACKEND      memory (預設) 或 sqlite
+    SESSION_SQLITE_PATH  sqlite 檔案路徑 (預設 sessions.sqlite3)
+    SESSION_MAX_ENTRIES  memory 後端最多保存的 session 數 (預設 10000)
+    SESSION_TTL          session 閒置多久後失效的秒數 (預設 86400)
+
+讀取 session 也算使用：期限在每次讀取時延長，sqlite 後端最多每 TTL/10 才寫回一次，
+避免每個只讀的請求都變成寫入。
+"""
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from sqlite_conn import ThreadLocalConnection
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+class MemorySessionStore:
+    """行程內、以 LRU 限制數量的 session 存放區"""
+
+    def __init__(self, max_entries=10000, ttl=86400, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            item = self._entries.get(sid)
+            if item is None:
+                return None
+            data, expires = item
+            now = self._clock()
+            if expires < now:
+                del self._entries[sid]
+                return None
+            self._entries[sid] = (data, now + self.ttl)
+            self._entries.move_to_end(sid)
+            return dict(data)
+
+    def set(self, sid, data):
+        with self._lock:
+            self._entries[sid] = (dict(data), self._clock() + self.ttl)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteSessionStore:
+    """存在 sqlite 檔案中的 session，同一台主機上的多個 worker 可共用"""
+
+    def __init__(self, path='sessions.sqlite3', ttl=86400, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self._clock = clock
+        self._serializer = TaggedJSONSerializer()
+        self._connect = ThreadLocalConnection(path)
+        self._writes = 0
+        # 讀取時延長期限的最短間隔
+        self.touch_interval = ttl / 10
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def get(self, sid):
+        row = self._connect().execute("SELECT data, expires FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        now = self._clock()
+        if row is None or row[1] < now:
+            return None
+        if now + self.ttl - row[1] >= self.touch_interval:
+            with self._connect() as conn:
+                conn.execute("UPDATE sessions SET expires = ? WHERE sid = ?", (now + self.ttl, sid))
+        return self._serializer.loads(row[0])
+
+    def set(self, sid, data):
+        now = self._clock()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+                         (sid, self._serializer.dumps(dict(data)), now + self.ttl))
+            # 不另開排程，每寫入一定次數順便清掉過期資料
+            self._writes += 1
+            if self._writes % 500 == 0:
+                conn.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+def store_from_env():
+    ttl = int(os.environ.get('SESSION_TTL', 86400))
+    if os.environ.get('SESSION_BACKEND', 'memory') == 'sqlite':
+        return SQLiteSessionStore(os.environ.get('SESSION_SQLITE_PATH', 'sessions.sqlite3'), ttl=ttl)
+    return MemorySessionStore(max_entries=int(os.environ.get('SESSION_MAX_ENTRIES', 10000)), ttl=ttl)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """換發新的 session id (登入時呼叫，防止 session fixation)；內容沿用，舊 id 在存檔時刪除"""
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = new_session_id()
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """把 Flask session 的內容放在 store 中，cookie 只存 session id"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        self.store.set(session.sid, session)
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
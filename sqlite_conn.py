@@ -0,0 +1,26 @@
+"""session、訂閱與課表快取共用的 sqlite 連線
+
+sqlite3 連線不能跨執行緒使用，fork 之後也不能沿用父行程的連線，因此每個執行緒、每個行程各開一條。
+WAL 模式讓讀取不必等寫入，多個 worker 可以同時讀；synchronous=NORMAL 在 WAL 下只在 checkpoint 時 fsync。
+"""
+import os
+import sqlite3
+import threading
+
+
+class ThreadLocalConnection:
+    """呼叫時回傳目前執行緒 (與行程) 專用的連線，第一次呼叫時才建立"""
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
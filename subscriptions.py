@@ -0,0 +1,134 @@
+"""行事曆訂閱 (webcal)：以可撤銷的隨機 token 提供預先產生好的 ICS
+
+每位使用者最多一個有效 token，重新產生時舊 token 立即失效。store 只保存 token 的 SHA-256，
+外洩的資料庫內容無法拿來訂閱。行事曆內容在查到新課表時預先產生並存起來，
+行事曆 App 輪詢時只讀出現成的位元組，不會呼叫校務系統。
+
+設定皆由環境變數讀取：
+    SUBSCRIPTION_BACKEND      memory (預設) 或 sqlite
+    SUBSCRIPTION_SQLITE_PATH  sqlite 檔案路徑 (預設 subscriptions.sqlite3)
+"""
+import hashlib
+import os
+import secrets
+import threading
+import time
+
+from sqlite_conn import ThreadLocalConnection
+
+
+def new_token():
+    return secrets.token_urlsafe(24)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def feed_etag(body):
+    return hashlib.sha1(body).hexdigest()[:20]
+
+
+class MemorySubscriptionStore:
+    """行程內的訂閱資料；多個 worker 時請改用 sqlite"""
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._tokens = {}   # token hash -> user_id
+        self._users = {}    # user_id -> token hash
+        self._feeds = {}    # user_id -> (etag, body, updated_at)
+        self._lock = threading.Lock()
+
+    def create(self, user_id):
+        token = new_token()
+        with self._lock:
+            old = self._users.pop(user_id, None)
+            if old is not None:
+                self._tokens.pop(old, None)
+            self._tokens[hash_token(token)] = user_id
+            self._users[user_id] = hash_token(token)
+        return token
+
+    def revoke(self, user_id):
+        with self._lock:
+            old = self._users.pop(user_id, None)
+            if old is not None:
+                self._tokens.pop(old, None)
+            self._feeds.pop(user_id, None)
+            return old is not None
+
+    def is_subscribed(self, user_id):
+        return user_id in self._users
+
+    def put_feed(self, user_id, body):
+        """存入新的行事曆內容，內容沒變時不更新並回傳 False"""
+        etag = feed_etag(body)
+        with self._lock:
+            if user_id not in self._users:
+                return False
+            current = self._feeds.get(user_id)
+            if current is not None and current[0] == etag:
+                return False
+            self._feeds[user_id] = (etag, body, self._clock())
+            return True
+
+    def current_etag(self, token):
+        with self._lock:
+            feed = self._feeds.get(self._tokens.get(hash_token(token)))
+            return feed[0] if feed else None
+
+    def get_feed(self, token):
+        """回傳 (etag, 內容, 更新時間)，token 無效時回傳 None"""
+        with self._lock:
+            return self._feeds.get(self._tokens.get(hash_token(token)))
+
+
+class SQLiteSubscriptionStore:
+    """存在 sqlite 檔案中的訂閱資料，同一台主機上的多個 worker 可共用"""
+
+    def __init__(self, path='subscriptions.sqlite3', clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._connect = ThreadLocalConnection(path)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS subscriptions (user_id TEXT PRIMARY KEY, token_hash TEXT NOT NULL UNIQUE, "
+                         "created_at REAL NOT NULL, etag TEXT, body BLOB, updated_at REAL)")
+
+    def create(self, user_id):
+        token = new_token()
+        with self._connect() as conn:
+            # 保留已產生的行事曆內容，只換 token
+            conn.execute("INSERT INTO subscriptions (user_id, token_hash, created_at) VALUES (?, ?, ?) "
+                         "ON CONFLICT(user_id) DO UPDATE SET token_hash = excluded.token_hash, created_at = excluded.created_at",
+                         (user_id, hash_token(token), self._clock()))
+        return token
+
+    def revoke(self, user_id):
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,)).rowcount > 0
+
+    def is_subscribed(self, user_id):
+        return self._connect().execute("SELECT 1 FROM subscriptions WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def put_feed(self, user_id, body):
+        etag = feed_etag(body)
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE subscriptions SET etag = ?, body = ?, updated_at = ? "
+                                  "WHERE user_id = ? AND etag IS NOT ?", (etag, body, self._clock(), user_id, etag))
+            return cursor.rowcount > 0
+
+    def current_etag(self, token):
+        # 304 的情況只讀 etag，不讀出整份內容
+        row = self._connect().execute("SELECT etag FROM subscriptions WHERE token_hash = ?", (hash_token(token),)).fetchone()
+        return row[0] if row else None
+
+    def get_feed(self, token):
+        row = self._connect().execute("SELECT etag, body, updated_at FROM subscriptions WHERE token_hash = ? AND body IS NOT NULL",
+                                      (hash_token(token),)).fetchone()
+        return (row[0], bytes(row[1]), row[2]) if row else None
+
+
+def subscription_store_from_env():
+    if os.environ.get('SUBSCRIPTION_BACKEND', 'memory') == 'sqlite':
+        return SQLiteSubscriptionStore(os.environ.get('SUBSCRIPTION_SQLITE_PATH', 'subscriptions.sqlite3'))
+    return MemorySubscriptionStore()
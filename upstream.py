@@ -0,0 +1,428 @@
+"""東吳校務系統 jsonApi.php 的共用上游連線
+
+每個 worker 行程只保留一個 requests.Session，讓 TCP/TLS 連線在多次請求之間重用。
+設定皆由環境變數讀取：
+    UPSTREAM_POOL_SIZE     保留的 host 連線池數量 (預設 4)
+    UPSTREAM_MAX_PER_HOST  每個 host 最多同時開啟的連線數 (預設 10)
+    UPSTREAM_TIMEOUT       連線/讀取逾時秒數，格式 "connect,read" (預設 "5,30")
+    ASYNC_UPSTREAM_MAX_CONNECTIONS  ASGI 模式下同時開啟的上游連線上限 (預設 200)
+    UPSTREAM_COALESCE      相同的並行請求 (libName 與參數皆相同) 共用一次上游呼叫 (預設 1，設為 0 關閉)
+    UPSTREAM_MAX_CONCURRENCY     每個 worker 同時進行的上游呼叫上限 (預設同 max_per_host)
+    UPSTREAM_ADMISSION_TIMEOUT   排不到名額時最多等待的秒數，超過即快速失敗 (預設 0.5)
+    BREAKER_FAILURE_RATE         斷路器跳脫的失敗 (含過慢) 比例 (預設 0.5)
+    BREAKER_SLOW_CALL_SECONDS    超過此秒數的呼叫視為失敗 (預設 8)
+    BREAKER_WINDOW / BREAKER_MIN_CALLS  統計最近幾次呼叫 / 至少幾次才判斷 (預設 20 / 10)
+    BREAKER_OPEN_SECONDS         跳脫後多久進入 half-open 試探 (預設 30)
+    BREAKER_HALF_OPEN_PROBES     half-open 時放行的試探請求數 (預設 2)
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from circuit_breaker import CircuitBreaker
+from metrics import UPSTREAM_COALESCED, UPSTREAM_LATENCY, UPSTREAM_REJECTED, UPSTREAM_REQUESTS
+
+# 與原本兩個 handler 重複的共用標頭
+COMMON_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded",
+    "User-Agent": "Mozilla/5.0",
+}
+
+
+CIRCUIT_OPEN_MESSAGE = "校務系統目前無法連線，請稍後再試"
+BUSY_MESSAGE = "目前查詢人數過多，請稍後再試"
+
+
+class UpstreamUnavailable(Exception):
+    """斷路器跳脫或排不到上游名額時快速失敗，沒有真的呼叫校務系統"""
+
+    def __init__(self, message, retry_after=1, reason='circuit_open'):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def breaker_from_env():
+    return CircuitBreaker(
+        failure_rate=float(os.environ.get('BREAKER_FAILURE_RATE', 0.5)),
+        slow_call_seconds=float(os.environ.get('BREAKER_SLOW_CALL_SECONDS', 8)),
+        window=int(os.environ.get('BREAKER_WINDOW', 20)),
+        min_calls=int(os.environ.get('BREAKER_MIN_CALLS', 10)),
+        open_seconds=float(os.environ.get('BREAKER_OPEN_SECONDS', 30)),
+        half_open_probes=int(os.environ.get('BREAKER_HALF_OPEN_PROBES', 2)),
+    )
+
+
+def _admission_from_env(max_per_host):
+    return {"max_concurrency": int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', max_per_host)),
+            "admission_timeout": float(os.environ.get('UPSTREAM_ADMISSION_TIMEOUT', 0.5)),
+            "breaker": breaker_from_env()}
+
+
+def _reject_if_open(breaker, lib_name):
+    if not breaker.allow():
+        UPSTREAM_REJECTED.inc(lib_name, 'circuit_open')
+        raise UpstreamUnavailable(CIRCUIT_OPEN_MESSAGE, breaker.retry_after(), 'circuit_open')
+
+
+def _reject_busy(breaker, lib_name):
+    breaker.cancel()
+    UPSTREAM_REJECTED.inc(lib_name, 'concurrency')
+    raise UpstreamUnavailable(BUSY_MESSAGE, 1, 'concurrency')
+
+
+class _PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connects = 0
+
+    def add_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def add_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def snapshot(self):
+        with self._lock:
+            requests_, connects = self.requests, self.connects
+        # 每次真正建立 TCP(+TLS) 連線就是一次 miss，其餘請求都重用了池中的連線
+        return {"requests": requests_, "hits": max(requests_ - connects, 0), "misses": connects}
+
+
+def _counting_pool_classes(stats):
+    """產生會在每次實際 connect() 時計數的連線池類別"""
+    class _HTTPConnection(HTTPConnection):
+        def connect(self):
+            stats.add_connect()
+            return super().connect()
+
+    class _HTTPSConnection(HTTPSConnection):
+        def connect(self):
+            stats.add_connect()
+            return super().connect()
+
+    class _HTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = _HTTPConnection
+
+    class _HTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = _HTTPSConnection
+
+    return {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _counting_pool_classes(self._stats)
+
+
+# 每個行程各自隨機產生；沒有這把金鑰就無法由 key 反推或驗證猜測的帳號密碼
+_FLIGHT_SECRET = os.urandom(32)
+
+
+def flight_key(lib_name, params):
+    # 參數含密碼，只保留 HMAC；key 只在行程內使用，統計只回報各 libName 的等待數
+    digest = hmac.new(_FLIGHT_SECRET, json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8'), hashlib.sha256)
+    return lib_name, digest.hexdigest()
+
+
+def _waiters_by_lib(items):
+    """[((libName, 雜湊), 等待數)] -> {libName: 等待數}"""
+    counts = {}
+    for (lib_name, _), waiters in items:
+        counts[lib_name] = counts.get(lib_name, 0) + waiters
+    return counts
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """同一個 key 同時只執行一次 fn，期間到達的呼叫等待並共用同一個結果 (或例外)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        """回傳 (結果, 是否共用了其他呼叫的結果)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def waiters(self):
+        with self._lock:
+            return _waiters_by_lib((key, flight.waiters) for key, flight in self._flights.items())
+
+
+class AsyncSingleFlight:
+    """SingleFlight 的 asyncio 版本；上游呼叫在獨立的 task 中執行，發起者斷線取消時不影響其他等待者"""
+
+    def __init__(self):
+        self._flights = {}
+        self._waiters = {}
+        self.shared = 0
+
+    async def do(self, key, factory):
+        task = self._flights.get(key)
+        leader = task is None
+        if leader:
+            task = self._flights[key] = asyncio.ensure_future(factory())
+            self._waiters[key] = 0
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self._waiters[key] += 1
+            self.shared += 1
+        return await asyncio.shield(task), not leader
+
+    def _finish(self, key, task):
+        self._flights.pop(key, None)
+        self._waiters.pop(key, None)
+        # 所有等待者都已離開時，避免 asyncio 回報例外未被取出
+        if not task.cancelled():
+            task.exception()
+
+    def waiters(self):
+        return _waiters_by_lib(self._waiters.items())
+
+
+def _observe(lib_name, status, start):
+    # status 是 HTTP 狀態碼；連不上或讀取失敗時為 error，逾時為 timeout
+    UPSTREAM_LATENCY.observe(lib_name, value=time.perf_counter() - start)
+    UPSTREAM_REQUESTS.inc(lib_name, status)
+
+
+def _parse_timeout(value):
+    parts = [float(p) for p in value.split(',') if p.strip()]
+    return tuple(parts) if len(parts) == 2 else parts[0]
+
+
+class UpstreamClient:
+    """對 BASE_URL/jsonApi.php 發送請求的連線池用戶端"""
+
+    def __init__(self, base_url, pool_size=4, max_per_host=10, timeout=(5, 30), coalesce=True,
+                 max_concurrency=None, admission_timeout=0.5, breaker=None):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/jsonApi.php"
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.stats = _PoolStats()
+        self.flights = SingleFlight() if coalesce else None
+        # 上游變慢時，限制同時卡在上游的執行緒數，其餘執行緒仍可服務首頁與 ICS 匯出
+        self.max_concurrency = max_concurrency or max_per_host
+        self.admission_timeout = admission_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, base_url):
+        return cls(
+            base_url,
+            pool_size=int(os.environ.get('UPSTREAM_POOL_SIZE', 4)),
+            max_per_host=int(os.environ.get('UPSTREAM_MAX_PER_HOST', 10)),
+            timeout=_parse_timeout(os.environ.get('UPSTREAM_TIMEOUT', '5,30')),
+            coalesce=os.environ.get('UPSTREAM_COALESCE', '1') != '0',
+            **_admission_from_env(int(os.environ.get('UPSTREAM_MAX_PER_HOST', 10))),
+        )
+
+    def _build_session(self):
+        s = requests.Session()
+        # pool_block=True 讓每個 host 的連線數真正被 max_per_host 限制住
+        adapter = _CountingAdapter(self.stats, pool_connections=self.pool_size,
+                                   pool_maxsize=self.max_per_host, pool_block=True)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        s.headers.update(COMMON_HEADERS)
+        s.headers['Referer'] = self.base_url
+        return s
+
+    @property
+    def session(self):
+        # gunicorn 會在 fork 後沿用父行程的物件，socket 不能跨行程共用，所以依 pid 重建
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    self._session = self._build_session()
+                    self._pid = pid
+        return self._session
+
+    def call(self, lib_name, **params):
+        """呼叫 jsonApi.php 並回傳解析後的 JSON；HTTP 錯誤會拋出 requests.RequestException
+
+        相同的並行呼叫共用同一個回傳物件，呼叫端不可修改它。
+        """
+        if self.flights is None:
+            return self._post(lib_name, params)
+        result, shared = self.flights.do(flight_key(lib_name, params), lambda: self._post(lib_name, params))
+        if shared:
+            UPSTREAM_COALESCED.inc(lib_name)
+        return result
+
+    def _post(self, lib_name, params):
+        _reject_if_open(self.breaker, lib_name)
+        if not self._slots.acquire(timeout=self.admission_timeout):
+            _reject_busy(self.breaker, lib_name)
+        self.stats.add_request()
+        start, status, ok = time.perf_counter(), 'error', False
+        try:
+            response = self.session.post(self.api_url, data={"libName": lib_name, **params}, timeout=self.timeout)
+            status = str(response.status_code)
+            response.raise_for_status()
+            result = response.json()
+            ok = True
+            return result
+        except requests.Timeout:
+            status = 'timeout'
+            raise
+        finally:
+            self._slots.release()
+            self.breaker.record(ok, time.perf_counter() - start)
+            _observe(lib_name, status, start)
+
+    def pool_stats(self):
+        return {**self.stats.snapshot(), "pool_size": self.pool_size, "max_per_host": self.max_per_host,
+                "max_concurrency": self.max_concurrency, "breaker": self.breaker.snapshot(), **_flight_stats(self.flights)}
+
+
+def _flight_stats(flights):
+    if flights is None:
+        return {}
+    return {"coalesced": flights.shared, "inflight_waiters": flights.waiters()}
+
+
+class AsyncUpstreamClient:
+    """UpstreamClient 的 asyncio 版本，給 ASGI 模式使用 (需要 aiohttp)"""
+
+    def __init__(self, base_url, pool_size=4, max_per_host=10, timeout=(5, 30), coalesce=True,
+                 max_concurrency=None, admission_timeout=0.5, breaker=None):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/jsonApi.php"
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.stats = _PoolStats()
+        self.flights = AsyncSingleFlight() if coalesce else None
+        self.max_concurrency = max_concurrency or max_per_host
+        self.admission_timeout = admission_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._session = None
+
+    @classmethod
+    def from_env(cls, base_url):
+        # 非同步模式下等待上游不佔用 worker，連線上限可以比同步模式大得多
+        return cls(
+            base_url,
+            pool_size=int(os.environ.get('UPSTREAM_POOL_SIZE', 4)),
+            max_per_host=int(os.environ.get('ASYNC_UPSTREAM_MAX_CONNECTIONS', 200)),
+            timeout=_parse_timeout(os.environ.get('UPSTREAM_TIMEOUT', '5,30')),
+            coalesce=os.environ.get('UPSTREAM_COALESCE', '1') != '0',
+            **_admission_from_env(int(os.environ.get('ASYNC_UPSTREAM_MAX_CONNECTIONS', 200))),
+        )
+
+    def _build_session(self):
+        import aiohttp
+        connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+        trace = aiohttp.TraceConfig()
+
+        async def on_connection_create_end(session, context, params):
+            self.stats.add_connect()
+
+        trace.on_connection_create_end.append(on_connection_create_end)
+        connector = aiohttp.TCPConnector(limit=self.max_per_host, limit_per_host=self.max_per_host)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace],
+                                     timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+                                     headers={**COMMON_HEADERS, "Referer": self.base_url})
+
+    async def call(self, lib_name, **params):
+        """呼叫 jsonApi.php 並回傳解析後的 JSON；HTTP 錯誤會拋出 aiohttp.ClientError"""
+        if self.flights is None:
+            return await self._post(lib_name, params)
+        result, shared = await self.flights.do(flight_key(lib_name, params), lambda: self._post(lib_name, params))
+        if shared:
+            UPSTREAM_COALESCED.inc(lib_name)
+        return result
+
+    async def _post(self, lib_name, params):
+        _reject_if_open(self.breaker, lib_name)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.admission_timeout)
+        except asyncio.TimeoutError:
+            _reject_busy(self.breaker, lib_name)
+        if self._session is None:
+            self._session = self._build_session()
+        self.stats.add_request()
+        start, status, ok = time.perf_counter(), 'error', False
+        try:
+            async with self._session.post(self.api_url, data={"libName": lib_name, **params}) as response:
+                status = str(response.status)
+                response.raise_for_status()
+                # 校務系統回傳的 Content-Type 不一定是 application/json，因此不檢查
+                result = await response.json(content_type=None)
+                ok = True
+                return result
+        except asyncio.TimeoutError:
+            status = 'timeout'
+            raise
+        finally:
+            self._slots.release()
+            self.breaker.record(ok, time.perf_counter() - start)
+            _observe(lib_name, status, start)
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def pool_stats(self):
+        return {**self.stats.snapshot(), "pool_size": self.pool_size, "max_per_host": self.max_per_host,
+                "max_concurrency": self.max_concurrency, "breaker": self.breaker.snapshot(), **_flight_stats(self.flights)}
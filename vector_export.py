@@ -0,0 +1,168 @@
+"""課表的向量匯出 (SVG / PDF)，純 Python 產生，不需要瀏覽器端的 html2canvas/jsPDF
+
+版面與網頁列印樣式 (.is-printing) 相同：標題、星期列、節次欄與依 span 合併的課程格子。
+先由 layout_timetable() 算出每個格子的位置與文字，再交給 render_svg() 或 render_pdf() 輸出。
+
+PDF 使用不內嵌的 CID 字型 MSung-Light 與 UniCNS-UCS2-H 編碼，檔案只有幾 KB；
+閱讀器會以系統中的中文字型替代顯示。
+"""
+import html
+import re
+import zlib
+
+# A4 橫向 (pt)
+PAGE_SIZE = (842, 595)
+MARGIN = 24
+GAP = 2
+TITLE_HEIGHT = 28
+HEADER_HEIGHT = 30
+TIME_COLUMN_WIDTH = 78
+LINE_HEIGHT = 1.25
+
+TITLE_SIZE, HEADER_SIZE, CELL_SIZE = 14, 9, 7.5
+HEADER_FILL, CELL_FILL, BORDER, TEXT = '#f2f2f2', '#ffffff', '#dddddd', '#000000'
+
+SVG_FONT_FAMILY = "'Noto Sans TC', 'PingFang TC', 'Microsoft JhengHei', sans-serif"
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_BR_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+
+
+def html_lines(text):
+    """把課程文字 (含 <br> 與 &nbsp;) 轉成純文字行"""
+    lines = (html.unescape(_TAG_RE.sub('', part)).replace('\xa0', ' ').strip() for part in _BR_RE.split(text or ''))
+    return [line for line in lines if line]
+
+
+def text_width(text, size):
+    # 不量字型，以半形 0.5em、全形 1em 估算；PDF 的 /W 也用同樣的寬度
+    return sum(0.5 if ord(ch) < 128 else 1.0 for ch in text) * size
+
+
+def wrap_lines(lines, width, size, max_lines):
+    """依估算寬度逐字換行，超過 max_lines 時最後一行以 … 結尾"""
+    wrapped = []
+    for line in lines:
+        current, current_width = '', 0.0
+        for ch in line:
+            w = text_width(ch, size)
+            if current and current_width + w > width:
+                wrapped.append(current)
+                current, current_width = '', 0.0
+            current += ch
+            current_width += w
+        if current:
+            wrapped.append(current)
+    if len(wrapped) > max_lines:
+        wrapped = wrapped[:max_lines]
+        last = wrapped[-1]
+        while last and text_width(last + '…', size) > width:
+            last = last[:-1]
+        wrapped[-1] = last + '…'
+    return wrapped
+
+
+def layout_timetable(title, day_labels, slots, cells, page_size=PAGE_SIZE):
+    """回傳 (寬, 高, 格子清單)
+
+    slots 為每節的 (節次, 時間文字)；cells 為 (slot, day, span, 課程文字)，空堂的課程文字為空字串。
+    每個格子是 (x, y, w, h, 填色, 框線色, 文字行, 字級)，座標原點在左上角。
+    """
+    width, height = page_size
+    boxes = [(MARGIN, MARGIN, width - 2 * MARGIN, TITLE_HEIGHT, None, None, [title], TITLE_SIZE)]
+    top = MARGIN + TITLE_HEIGHT + GAP
+    day_width = (width - 2 * MARGIN - TIME_COLUMN_WIDTH - 7 * GAP) / 7
+    num_slots = max(len(slots), 1)
+    row_height = (height - top - MARGIN - HEADER_HEIGHT - num_slots * GAP) / num_slots
+
+    def column_x(day):
+        return MARGIN + TIME_COLUMN_WIDTH + GAP + day * (day_width + GAP)
+
+    def row_y(slot):
+        return top + HEADER_HEIGHT + GAP + slot * (row_height + GAP)
+
+    boxes.append((MARGIN, top, TIME_COLUMN_WIDTH, HEADER_HEIGHT, HEADER_FILL, BORDER, [], HEADER_SIZE))
+    for day, label in enumerate(day_labels):
+        boxes.append((column_x(day), top, day_width, HEADER_HEIGHT, HEADER_FILL, BORDER, html_lines(label), HEADER_SIZE))
+    for slot, (label, time_text) in enumerate(slots):
+        lines = [label, ' - '.join(html_lines(time_text))] if time_text else [label]
+        boxes.append((MARGIN, row_y(slot), TIME_COLUMN_WIDTH, row_height, HEADER_FILL, BORDER, lines, HEADER_SIZE))
+    max_cell_lines = max(int((row_height - 4) / (CELL_SIZE * LINE_HEIGHT)), 1)
+    for slot, day, span, text in cells:
+        h = span * row_height + (span - 1) * GAP
+        lines = wrap_lines(html_lines(text), day_width - 6, CELL_SIZE, max_cell_lines * span)
+        boxes.append((column_x(day), row_y(slot), day_width, h, CELL_FILL, BORDER, lines, CELL_SIZE))
+    return width, height, boxes
+
+
+def _line_offsets(lines, size):
+    # 多行文字在格子內垂直置中：回傳每行基線相對於格子中心的位移
+    step = size * LINE_HEIGHT
+    first = -step * (len(lines) - 1) / 2 + size * 0.35
+    return [first + i * step for i in range(len(lines))]
+
+
+def render_svg(layout):
+    width, height, boxes = layout
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}pt" height="{height}pt" viewBox="0 0 {width} {height}" '
+             f'font-family="{SVG_FONT_FAMILY}" fill="{TEXT}">',
+             f'<rect width="{width}" height="{height}" fill="#ffffff"/>']
+    for x, y, w, h, fill, stroke, lines, size in boxes:
+        if fill:
+            parts.append(f'<rect x="{x:.2f}" y="{y:.2f}" width="{w:.2f}" height="{h:.2f}" rx="3" fill="{fill}" stroke="{stroke}" stroke-width="0.75"/>')
+        if lines:
+            cx, cy = x + w / 2, y + h / 2
+            spans = ''.join(f'<tspan x="{cx:.2f}" y="{cy + dy:.2f}">{html.escape(line, quote=False)}</tspan>'
+                            for line, dy in zip(lines, _line_offsets(lines, size)))
+            parts.append(f'<text font-size="{size}" text-anchor="middle">{spans}</text>')
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def _pdf_color(hex_color):
+    return ' '.join(f'{int(hex_color[i:i + 2], 16) / 255:.3g}' for i in (1, 3, 5))
+
+
+def _pdf_text(text):
+    # UniCNS-UCS2-H 以 UCS-2 編碼，BMP 以外的字元無法表示
+    return '<' + ''.join(f'{ord(ch):04X}' if ord(ch) < 0x10000 else '003F' for ch in text) + '>'
+
+
+def render_pdf(layout):
+    width, height, boxes = layout
+    ops = []
+    for x, y, w, h, fill, stroke, lines, size in boxes:
+        if fill:
+            ops.append(f'{_pdf_color(fill)} rg {_pdf_color(stroke)} RG 0.75 w {x:.2f} {height - y - h:.2f} {w:.2f} {h:.2f} re B')
+        if lines:
+            ops.append(f'{_pdf_color(TEXT)} rg')
+            cx, cy = x + w / 2, y + h / 2
+            for line, dy in zip(lines, _line_offsets(lines, size)):
+                tx = cx - text_width(line, size) / 2
+                ops.append(f'BT /F1 {size} Tf {tx:.2f} {height - cy - dy:.2f} Td {_pdf_text(line)} Tj ET')
+    content = zlib.compress('\n'.join(ops).encode('ascii'), 9)
+
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] '
+        f'/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>'.encode('ascii'),
+        f'<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n'.encode('ascii') + content + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type0 /BaseFont /MSung-Light /Encoding /UniCNS-UCS2-H /DescendantFonts [6 0 R] >>',
+        # Adobe-CNS1 的 CID 1-95 是半形 ASCII，其餘為全形
+        b'<< /Type /Font /Subtype /CIDFontType0 /BaseFont /MSung-Light '
+        b'/CIDSystemInfo << /Registry (Adobe) /Ordering (CNS1) /Supplement 0 >> '
+        b'/FontDescriptor 7 0 R /DW 1000 /W [1 95 500] >>',
+        b'<< /Type /FontDescriptor /FontName /MSung-Light /Flags 6 /FontBBox [-160 -249 1015 888] '
+        b'/ItalicAngle 0 /Ascent 880 /Descent -120 /CapHeight 880 /StemV 93 >>',
+    ]
+    out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n'.encode('ascii') + body + b'\nendobj\n'
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('ascii')
+    out += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('ascii')
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('ascii')
+    return bytes(out)
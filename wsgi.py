@@ -0,0 +1,7 @@
+"""正式環境的 WSGI 進入點
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app
+
+app = create_app()